@@ -0,0 +1,133 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""mlnx segmentation_id blocks
+
+Revision ID: 3e1f6b7a2d54
+Revises: 4c8a5e2d9b31
+Create Date: 2013-11-21 14:37:09.215836
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e1f6b7a2d54'
+down_revision = '4c8a5e2d9b31'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.mlnx.mlnx_plugin.MellanoxEswitchPlugin'
+]
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import sql
+
+from neutron.db import migration
+
+# number of segmentation_ids covered by a block row
+BLOCK_SIZE = 256
+
+allocations = sql.table('segmentation_id_allocation',
+                        sql.column('physical_network', sa.String(64)),
+                        sql.column('segmentation_id', sa.Integer),
+                        sql.column('allocated', sa.Boolean))
+
+blocks = sql.table('segmentation_id_blocks',
+                   sql.column('physical_network', sa.String(64)),
+                   sql.column('first_id', sa.Integer),
+                   sql.column('allocatable', sa.String(64)),
+                   sql.column('allocated', sa.String(64)),
+                   sql.column('free_count', sa.Integer))
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.create_table(
+        'segmentation_id_blocks',
+        sa.Column('physical_network', sa.String(length=64), nullable=False),
+        sa.Column('first_id', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('allocatable', sa.String(length=64), nullable=False),
+        sa.Column('allocated', sa.String(length=64), nullable=False),
+        sa.Column('free_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('physical_network', 'first_id')
+    )
+    op.create_index('ix_segmentation_id_blocks_free_count',
+                    'segmentation_id_blocks', ['free_count'])
+
+    # every row was allocatable or allocated, the plugin recomputes the
+    # allocatable bitmaps from its VLAN ranges when it starts
+    bitmaps = {}
+    for physical_network, segmentation_id, allocated in op.get_bind().execute(
+            sql.select([allocations.c.physical_network,
+                        allocations.c.segmentation_id,
+                        allocations.c.allocated])):
+        first_id = segmentation_id - segmentation_id % BLOCK_SIZE
+        bit = 1 << (segmentation_id - first_id)
+        bitmap = bitmaps.setdefault((physical_network, first_id), [0, 0])
+        bitmap[0] |= bit
+        if allocated:
+            bitmap[1] |= bit
+    rows = []
+    for (physical_network, first_id), bitmap in bitmaps.iteritems():
+        rows.append({'physical_network': physical_network,
+                     'first_id': first_id,
+                     'allocatable': '%x' % bitmap[0],
+                     'allocated': '%x' % bitmap[1],
+                     'free_count': bin(bitmap[0] & ~bitmap[1]).count('1')})
+    if rows:
+        op.bulk_insert(blocks, rows)
+
+    op.drop_table('segmentation_id_allocation')
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.create_table(
+        'segmentation_id_allocation',
+        sa.Column('physical_network', sa.String(length=64), nullable=False),
+        sa.Column('segmentation_id', sa.Integer(), autoincrement=False,
+                  nullable=False),
+        sa.Column('allocated', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('physical_network', 'segmentation_id')
+    )
+
+    rows = []
+    for physical_network, first_id, allocatable, allocated in (
+            op.get_bind().execute(
+                sql.select([blocks.c.physical_network, blocks.c.first_id,
+                            blocks.c.allocatable, blocks.c.allocated]))):
+        allocatable = int(allocatable, 16)
+        allocated = int(allocated, 16)
+        for n in xrange(BLOCK_SIZE):
+            bit = 1 << n
+            if (allocatable | allocated) & bit:
+                rows.append({'physical_network': physical_network,
+                             'segmentation_id': first_id + n,
+                             'allocated': bool(allocated & bit)})
+    if rows:
+        op.bulk_insert(allocations, rows)
+
+    op.drop_index('ix_segmentation_id_blocks_free_count',
+                  'segmentation_id_blocks')
+    op.drop_table('segmentation_id_blocks')
@@ -0,0 +1,54 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""mlnx ports mac_address index
+
+Revision ID: 4c8a5e2d9b31
+Revises: havana
+Create Date: 2013-11-20 10:12:41.683541
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c8a5e2d9b31'
+down_revision = 'havana'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.mlnx.mlnx_plugin.MellanoxEswitchPlugin'
+]
+
+from alembic import op
+
+from neutron.db import migration
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    # the agents identify their devices by MAC address
+    op.create_index('ix_ports_mac_address', 'ports', ['mac_address'])
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.drop_index('ix_ports_mac_address', 'ports')
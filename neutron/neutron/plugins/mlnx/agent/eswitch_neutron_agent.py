@@ -16,11 +16,13 @@
 # limitations under the License.
 
 
+import os
 import socket
 import sys
 import time
 
 import eventlet
+from eventlet import queue
 from oslo.config import cfg
 
 from neutron.agent import rpc as agent_rpc
@@ -30,8 +32,10 @@ from neutron.common import constants as q_constants
 from neutron.common import topics
 from neutron.common import utils as q_utils
 from neutron import context
+from neutron.openstack.common import jsonutils
 from neutron.openstack.common import log as logging
 from neutron.openstack.common import loopingcall
+from neutron.openstack.common import rpc
 from neutron.openstack.common.rpc import common as rpc_common
 from neutron.openstack.common.rpc import dispatcher
 from neutron.plugins.mlnx.agent import utils
@@ -41,33 +45,119 @@ from neutron.plugins.mlnx.common import exceptions
 
 LOG = logging.getLogger(__name__)
 
+# seconds port_update status reports are held to be sent together
+DEVICES_STATUS_DELAY = 0.2
+
+# version of the agent state file format
+STATE_FILE_VERSION = 1
+
+# upper bounds in seconds of the agent loop iteration duration buckets
+LOOP_DURATION_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30)
+
 
 class EswitchManager(object):
-    def __init__(self, interface_mappings, endpoint, timeout):
-        self.utils = utils.EswitchUtils(endpoint, timeout)
+    def __init__(self, interface_mappings, endpoint, timeout,
+                 vnics_max_age=0, failure_threshold=3,
+                 reconnect_max_interval=30, codecs=('msgpack', 'json')):
+        self.utils = utils.EswitchUtils(endpoint, timeout, failure_threshold,
+                                        reconnect_max_interval, codecs)
         self.interface_mappings = interface_mappings
+        # snapshot of the MACs of the attached vNICs and when it was taken
+        self.vnics = set()
+        self.vnics_updated = None
+        # eSwitchD generation of the snapshot, to only get what changed
+        # since when it is taken again
+        self.vnics_generation = None
+        # seconds the snapshot may be used before it is taken again
+        self.vnics_max_age = vnics_max_age
+        # network_id -> network data, 'ports' holds the MACs of its ports
         self.network_map = {}
+        # port_mac -> port record
+        self.port_map = {}
+        # port_id -> port_mac
+        self.port_id_map = {}
+        # whether the maps changed since get_state was called
+        self.state_changed = False
+        # port_mac -> (vlan, whether up) last programmed on the eSwitch
+        self.programmed = {}
+        # number of eSwitchD actions not sent as already programmed
+        self.skipped_ops = 0
         self.utils.define_fabric_mappings(interface_mappings)
 
     def get_port_id_by_mac(self, port_mac):
-        for network_id, data in self.network_map.iteritems():
-            for port in data['ports']:
-                if port['port_mac'] == port_mac:
-                    return port['port_id']
+        port = self.port_map.get(port_mac)
+        if port:
+            return port['port_id']
         err_msg = _("Agent cache inconsistency - port id "
                     "is not stored for %s") % port_mac
         LOG.error(err_msg)
-        raise exceptions.MlnxException(err_msg)
-
-    def get_vnics_mac(self):
-        return set(self.utils.get_attached_vnics().keys())
+        raise exceptions.MlnxException(err_msg=err_msg)
+
+    def get_port_mac_by_id(self, port_id):
+        return self.port_id_map.get(port_id)
+
+    def _add_port(self, network_id, port_id, port_mac):
+        self._remove_port(port_mac)
+        self.port_map[port_mac] = {'port_id': port_id,
+                                   'port_mac': port_mac,
+                                   'network_id': network_id}
+        self.port_id_map[port_id] = port_mac
+        self.network_map[network_id]['ports'].add(port_mac)
+        self.state_changed = True
+
+    def _remove_port(self, port_mac):
+        port = self.port_map.pop(port_mac, None)
+        if port:
+            self.state_changed = True
+            if self.port_id_map.get(port['port_id']) == port_mac:
+                del self.port_id_map[port['port_id']]
+            net_data = self.network_map.get(port['network_id'])
+            if net_data:
+                net_data['ports'].discard(port_mac)
+        return port
+
+    def _get_vnics(self, max_age=None):
+        if (max_age is None or self.vnics_updated is None or
+                time.time() - self.vnics_updated > max_age):
+            delta = self.utils.get_vnics_delta(self.vnics_generation)
+            if 'vnics' in delta:
+                self.vnics = set(delta['vnics'])
+            else:
+                self.vnics |= set(delta['added'])
+                self.vnics -= set(delta['removed'])
+            self.vnics_generation = delta['generation']
+            self.vnics_updated = time.time()
+        return self.vnics
+
+    def get_vnics_mac(self, max_age=None):
+        """Get the MACs of the attached vNICs.
+
+        The snapshot of the attached vNICs is used if it is at most
+        max_age seconds old, otherwise it is updated with the vNICs
+        eSwitchD attached and detached since. A max_age of None always
+        updates it.
+        """
+        return set(self._get_vnics(max_age))
+
+    def update_vnics(self, events):
+        """Apply vNIC attach/detach events to the snapshot."""
+        for event in events:
+            if event['event'] == utils.VNIC_ATTACHED:
+                self.vnics.add(event['mac'])
+            elif event['event'] == utils.VNIC_DETACHED:
+                self.vnics.discard(event['mac'])
+            else:
+                LOG.warning(_("Unknown vNIC event %s"), event)
 
     def vnic_port_exists(self, port_mac):
-        return port_mac in self.utils.get_attached_vnics()
+        return port_mac in self._get_vnics(self.vnics_max_age)
 
     def remove_network(self, network_id):
         if network_id in self.network_map:
+            for port_mac in list(self.network_map[network_id]['ports']):
+                self._remove_port(port_mac)
             del self.network_map[network_id]
+            self.state_changed = True
         else:
             LOG.debug(_("Network %s not defined on Agent."), network_id)
 
@@ -77,12 +167,18 @@ class EswitchManager(object):
         Check  internal network map for port data.
         If port exists set port to Down
         """
-        for network_id, data in self.network_map.iteritems():
-            for port in data['ports']:
-                if port['port_mac'] == port_mac:
-                    self.utils.port_down(physical_network, port_mac)
-                    return
+        self._raise_first(self._program(
+            self._port_down_msgs(network_id, physical_network, port_mac)))
+
+    def _port_down_msgs(self, network_id, physical_network, port_mac):
+        if port_mac in self.port_map:
+            if self.programmed.get(port_mac, (None, True))[1]:
+                return [utils.port_down_msg(physical_network, port_mac)]
+            self.skipped_ops += 1
+            LOG.debug(_("Port %s is already down"), port_mac)
+            return []
         LOG.info(_('Network %s is not available on this agent'), network_id)
+        return []
 
     def port_up(self, network_id, network_type,
                 physical_network, seg_id, port_id, port_mac):
@@ -93,37 +189,134 @@ class EswitchManager(object):
         - configure eswitch vport
         - set port to Up
         """
+        self._raise_first(self._program(
+            self._port_up_msgs(network_id, network_type,
+                               physical_network, seg_id,
+                               port_id, port_mac)))
+
+    def _port_up_msgs(self, network_id, network_type,
+                      physical_network, seg_id, port_id, port_mac):
         LOG.debug(_("Connecting port %s"), port_id)
 
+        if network_type not in (constants.TYPE_VLAN,
+                                constants.TYPE_IB):
+            LOG.error(_('Unsupported network type %s'), network_type)
+            return []
+
         if network_id not in self.network_map:
             self.provision_network(port_id, port_mac,
                                    network_id, network_type,
                                    physical_network, seg_id)
-        net_map = self.network_map[network_id]
-        net_map['ports'].append({'port_id': port_id, 'port_mac': port_mac})
+        self._add_port(network_id, port_id, port_mac)
 
-        if network_type in (constants.TYPE_VLAN,
-                            constants.TYPE_IB):
+        vlan, up = self.programmed.get(port_mac, (None, False))
+        msgs = []
+        if vlan == seg_id:
+            self.skipped_ops += 1
+            LOG.debug(_("Port %s is already on its VLAN"), port_mac)
+        else:
             LOG.info(_('Binding VLAN ID %(seg_id)s'
                        'to eSwitch for vNIC mac_address %(mac)s'),
                      {'seg_id': seg_id,
                       'mac': port_mac})
-            self.utils.set_port_vlan_id(physical_network,
-                                        seg_id,
-                                        port_mac)
-            self.utils.port_up(physical_network, port_mac)
+            msgs.append(utils.set_vlan_msg(physical_network, seg_id,
+                                           port_mac))
+        if up:
+            self.skipped_ops += 1
+            LOG.debug(_("Port %s is already up"), port_mac)
         else:
-            LOG.error(_('Unsupported network type %s'), network_type)
+            msgs.append(utils.port_up_msg(physical_network, port_mac))
+        return msgs
+
+    def _program(self, msgs):
+        """Send actions to eSwitchD and record what they programmed.
+
+        :returns: dict of port MAC to the error of its failed action
+        """
+        errors = {}
+        for msg, request in zip(msgs, self.utils.batch(msgs)):
+            port_mac = msg.get('port_mac') or msg['mac']
+            vlan, up = self.programmed.pop(port_mac, (None, None))
+            try:
+                request.wait()
+            except exceptions.MlnxException as e:
+                # what the eSwitch port is set to is not known anymore
+                errors.setdefault(port_mac, e)
+                continue
+            if port_mac in errors:
+                continue
+            if msg['action'] == 'set_vlan':
+                vlan = msg['vlan']
+            else:
+                up = msg['action'] == 'port_up'
+            self.programmed[port_mac] = (vlan, up)
+        return errors
+
+    def _raise_first(self, errors):
+        if errors:
+            raise errors.values()[0]
+
+    def bind_ports(self, devices_details):
+        """Set up or down a group of ports in one eSwitchD request.
+
+        :param devices_details: list of device details as returned by
+                                the plugin get_device_details RPC
+        :returns: set of port MACs whose eSwitch update failed
+        """
+        msgs = []
+        for details in devices_details:
+            if details['admin_state_up']:
+                port_msgs = self._port_up_msgs(details['network_id'],
+                                               details['network_type'],
+                                               details['physical_network'],
+                                               details['vlan_id'],
+                                               details['port_id'],
+                                               details['port_mac'])
+            else:
+                port_msgs = self._port_down_msgs(details['network_id'],
+                                                 details['physical_network'],
+                                                 details['port_mac'])
+            msgs.extend(port_msgs)
+
+        errors = self._program(msgs)
+        for mac, e in errors.iteritems():
+            LOG.error(_("Failed to set up port %(mac)s on eSwitch: "
+                        "%(exc)s"), {'mac': mac, 'exc': e})
+        return set(errors)
 
     def port_release(self, port_mac):
         """Clear port configuration from eSwitch."""
-        for network_id, net_data in self.network_map.iteritems():
-            for port in net_data['ports']:
-                if port['port_mac'] == port_mac:
-                    self.utils.port_release(net_data['physical_network'],
-                                            port['port_mac'])
-                    return
-        LOG.info(_('Port_mac %s is not available on this agent'), port_mac)
+        self._raise_first(self.release_ports([port_mac]))
+
+    def release_ports(self, port_macs):
+        """Clear the configuration of a group of ports in one request.
+
+        :returns: dict of port MAC to the error its release failed with
+        """
+        msgs = []
+        for port_mac in port_macs:
+            port = self.port_map.get(port_mac)
+            if port and port['network_id'] in self.network_map:
+                net_data = self.network_map[port['network_id']]
+                msgs.append(utils.port_release_msg(
+                    net_data['physical_network'], port_mac))
+                continue
+            self._remove_port(port_mac)
+            self.programmed.pop(port_mac, None)
+            LOG.info(_('Port_mac %s is not available on this agent'),
+                     port_mac)
+        errors = {}
+        for msg, request in zip(msgs, self.utils.batch(msgs)):
+            try:
+                request.wait()
+            except exceptions.MlnxException as e:
+                errors[msg['mac']] = e
+                continue
+            # forget the port only once released, so a failed release
+            # can be tried again
+            self._remove_port(msg['mac'])
+            self.programmed.pop(msg['mac'], None)
+        return errors
 
     def provision_network(self, port_id, port_mac,
                           network_id, network_type,
@@ -142,9 +335,31 @@ class EswitchManager(object):
         data = {
             'physical_network': physical_network,
             'network_type': network_type,
-            'ports': [],
+            'ports': set(),
             'vlan_id': segmentation_id}
         self.network_map[network_id] = data
+        self.state_changed = True
+
+    def get_state(self):
+        """Get the network and port maps in a JSON serializable form."""
+        self.state_changed = False
+        network_map = {}
+        for network_id, data in self.network_map.iteritems():
+            network_map[network_id] = dict(data, ports=list(data['ports']))
+        return {'network_map': network_map,
+                'port_map': self.port_map}
+
+    def restore_state(self, state):
+        """Restore the network and port maps from get_state output."""
+        self.network_map = {}
+        for network_id, data in state['network_map'].iteritems():
+            self.network_map[network_id] = dict(data,
+                                                ports=set(data['ports']))
+        self.port_map = state['port_map']
+        self.port_id_map = dict((port['port_id'], port_mac)
+                                for port_mac, port
+                                in self.port_map.iteritems())
+        self.state_changed = False
 
 
 class MlnxEswitchRpcCallbacks(sg_rpc.SecurityGroupAgentRpcCallbackMixin):
@@ -152,12 +367,14 @@ class MlnxEswitchRpcCallbacks(sg_rpc.SecurityGroupAgentRpcCallbackMixin):
     # Set RPC API version to 1.0 by default.
     # history
     #   1.1 Support Security Group RPC
-    RPC_API_VERSION = '1.1'
+    #   1.2 Support ports_update
+    RPC_API_VERSION = '1.2'
 
-    def __init__(self, context, eswitch):
+    def __init__(self, context, agent):
         self.context = context
-        self.eswitch = eswitch
-        self.sg_agent = eswitch
+        self.agent = agent
+        self.eswitch = agent.eswitch
+        self.sg_agent = agent
 
     def network_delete(self, context, **kwargs):
         LOG.debug(_("network_delete received"))
@@ -181,32 +398,30 @@ class MlnxEswitchRpcCallbacks(sg_rpc.SecurityGroupAgentRpcCallbackMixin):
         if self.eswitch.vnic_port_exists(port['mac_address']):
             if 'security_groups' in port:
                 self.sg_agent.refresh_firewall()
-            try:
-                if port['admin_state_up']:
-                    self.eswitch.port_up(net_id,
-                                         net_type,
-                                         physical_network,
-                                         segmentation_id,
-                                         port['id'],
-                                         port['mac_address'])
-                    # update plugin about port status
-                    self.agent.plugin_rpc.update_device_up(self.context,
-                                                           port['mac_address'],
-                                                           self.agent.agent_id)
-                else:
-                    self.eswitch.port_down(net_id,
-                                           physical_network,
-                                           port['mac_address'])
-                    # update plugin about port status
-                    self.agent.plugin_rpc.update_device_down(
-                        self.context,
-                        port['mac_address'],
-                        self.agent.agent_id)
-            except rpc_common.Timeout:
-                LOG.error(_("RPC timeout while updating port %s"), port['id'])
+            if port['admin_state_up']:
+                self.eswitch.port_up(net_id,
+                                     net_type,
+                                     physical_network,
+                                     segmentation_id,
+                                     port['id'],
+                                     port['mac_address'])
+            else:
+                self.eswitch.port_down(net_id,
+                                       physical_network,
+                                       port['mac_address'])
+            # update plugin about port status
+            self.agent.queue_device_status(port['mac_address'],
+                                           port['admin_state_up'])
         else:
             LOG.debug(_("No port %s defined on agent."), port['id'])
 
+    def ports_update(self, context, **kwargs):
+        """Handle the port updates sent to this host together."""
+        ports = kwargs.get('ports', [])
+        LOG.debug(_("ports_update received for %d ports"), len(ports))
+        for port_kwargs in ports:
+            self.port_update(context, **port_kwargs)
+
     def create_rpc_dispatcher(self):
         """Get the rpc dispatcher for this manager.
 
@@ -219,7 +434,27 @@ class MlnxEswitchRpcCallbacks(sg_rpc.SecurityGroupAgentRpcCallbackMixin):
 
 class MlnxEswitchPluginApi(agent_rpc.PluginApi,
                            sg_rpc.SecurityGroupServerRpcApiMixin):
-    pass
+
+    def get_devices_details_list(self, context, devices, agent_id):
+        return self.call(context,
+                         self.make_msg('get_devices_details_list',
+                                       devices=devices,
+                                       agent_id=agent_id),
+                         topic=self.topic, version='1.2')
+
+    def update_devices_down(self, context, devices, agent_id):
+        return self.call(context,
+                         self.make_msg('update_devices_down',
+                                       devices=devices,
+                                       agent_id=agent_id),
+                         topic=self.topic, version='1.3')
+
+    def update_devices_up(self, context, devices, agent_id):
+        return self.call(context,
+                         self.make_msg('update_devices_up',
+                                       devices=devices,
+                                       agent_id=agent_id),
+                         topic=self.topic, version='1.3')
 
 
 class MlnxEswitchNeutronAgent(sg_rpc.SecurityGroupAgentRpcMixin):
@@ -228,7 +463,25 @@ class MlnxEswitchNeutronAgent(sg_rpc.SecurityGroupAgentRpcMixin):
 
     def __init__(self, interface_mapping):
         self._polling_interval = cfg.CONF.AGENT.polling_interval
+        self._max_polling_interval = max(cfg.CONF.AGENT.max_polling_interval,
+                                         self._polling_interval)
+        self._full_sync_interval = cfg.CONF.AGENT.full_sync_interval
+        self._resync_interval = cfg.CONF.AGENT.resync_interval
+        self._retry_max_interval = cfg.CONF.AGENT.retry_max_interval
+        self.pool = eventlet.GreenPool(cfg.CONF.AGENT.device_workers)
+        # device -> (failed attempts, time of the next retry)
+        self.retries = {}
+        self.loop_metrics = {
+            'iterations': 0,
+            'overruns': 0,
+            'devices_added': 0,
+            'devices_removed': 0,
+            'devices_failed': 0,
+            # iterations per duration bucket, keyed by its upper bound
+            'durations': dict(('%s' % bound, 0)
+                              for bound in LOOP_DURATION_BUCKETS + ('inf',))}
         self._setup_eswitches(interface_mapping)
+        self._setup_vnic_events()
         self.agent_state = {
             'binary': 'neutron-mlnx-agent',
             'host': cfg.CONF.host,
@@ -242,12 +495,50 @@ class MlnxEswitchNeutronAgent(sg_rpc.SecurityGroupAgentRpcMixin):
     def _setup_eswitches(self, interface_mapping):
         daemon = cfg.CONF.ESWITCH.daemon_endpoint
         timeout = cfg.CONF.ESWITCH.request_timeout
-        self.eswitch = EswitchManager(interface_mapping, daemon, timeout)
+        self.eswitch = EswitchManager(
+            interface_mapping, daemon, timeout,
+            cfg.CONF.AGENT.vnics_max_age,
+            cfg.CONF.ESWITCH.failure_threshold,
+            cfg.CONF.ESWITCH.reconnect_max_interval,
+            cfg.CONF.ESWITCH.wire_codecs)
+
+    def _setup_vnic_events(self):
+        self.vnic_events = None
+        events_endpoint = cfg.CONF.ESWITCH.vnic_events_endpoint
+        if events_endpoint:
+            self.eswitch.utils.subscribe_vnic_events(events_endpoint)
+            self.vnic_events = queue.LightQueue()
+            eventlet.spawn_n(self._listen_vnic_events)
+
+    def _listen_vnic_events(self):
+        while True:
+            try:
+                self.vnic_events.put(self.eswitch.utils.recv_vnic_event())
+            except Exception:
+                LOG.exception(_("Failed receiving vNIC event"))
+                eventlet.sleep(self._polling_interval)
+
+    def _wait_for_vnic_events(self, timeout):
+        """Wait up to timeout seconds and return the events received."""
+        try:
+            events = [self.vnic_events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.vnic_events.get_nowait())
+            except queue.Empty:
+                return events
 
     def _report_state(self):
         try:
-            devices = len(self.eswitch.get_vnics_mac())
+            devices = len(self.eswitch.get_vnics_mac(
+                self.eswitch.vnics_max_age))
             self.agent_state['configurations']['devices'] = devices
+            self.agent_state['configurations']['loop_metrics'] = (
+                self.loop_metrics)
+            self.agent_state['configurations']['skipped_eswitch_ops'] = (
+                self.eswitch.skipped_ops)
             self.state_rpc.report_state(self.context,
                                         self.agent_state)
             self.agent_state.pop('start_flag', None)
@@ -260,11 +551,15 @@ class MlnxEswitchNeutronAgent(sg_rpc.SecurityGroupAgentRpcMixin):
 
         self.topic = topics.AGENT
         self.plugin_rpc = MlnxEswitchPluginApi(topics.PLUGIN)
+        self.devices_details_list_supported = True
+        self.devices_status_list_supported = True
+        # device -> whether it is up, for status reports not sent yet
+        self.devices_status = {}
         self.state_rpc = agent_rpc.PluginReportStateAPI(topics.PLUGIN)
         # RPC network init
         self.context = context.get_admin_context_without_session()
         # Handle updates from service
-        self.callbacks = MlnxEswitchRpcCallbacks(self.context, self.eswitch)
+        self.callbacks = MlnxEswitchRpcCallbacks(self.context, self)
         self.dispatcher = self.callbacks.create_rpc_dispatcher()
         # Define the listening consumers for the agent
         consumers = [[topics.PORT, topics.UPDATE],
@@ -273,14 +568,21 @@ class MlnxEswitchNeutronAgent(sg_rpc.SecurityGroupAgentRpcMixin):
         self.connection = agent_rpc.create_consumers(self.dispatcher,
                                                      self.topic,
                                                      consumers)
+        # port updates the server sends to this host only
+        self.host_connection = rpc.create_connection(new=True)
+        self.host_connection.create_consumer(
+            '%s.%s' % (topics.get_topic_name(self.topic, topics.PORT,
+                                             topics.UPDATE),
+                       cfg.CONF.host),
+            self.dispatcher, fanout=False)
+        self.host_connection.consume_in_thread()
 
         report_interval = cfg.CONF.AGENT.report_interval
         if report_interval:
             heartbeat = loopingcall.LoopingCall(self._report_state)
             heartbeat.start(interval=report_interval)
 
-    def update_ports(self, registered_ports):
-        ports = self.eswitch.get_vnics_mac()
+    def _diff_ports(self, registered_ports, ports):
         if ports == registered_ports:
             return
         added = ports - registered_ports
@@ -289,118 +591,384 @@ class MlnxEswitchNeutronAgent(sg_rpc.SecurityGroupAgentRpcMixin):
                 'added': added,
                 'removed': removed}
 
+    def update_ports(self, registered_ports):
+        return self._diff_ports(registered_ports,
+                                self.eswitch.get_vnics_mac())
+
+    def update_ports_from_events(self, registered_ports, events):
+        """Diff the registered ports with the vNICs known from events.
+
+        The vNIC snapshot taken by the last full sync is kept up to date
+        by the events, so it is not taken again here.
+        """
+        self.eswitch.update_vnics(events)
+        return self._diff_ports(registered_ports,
+                                self.eswitch.get_vnics_mac(
+                                    self._full_sync_interval))
+
+    def _hold_back_retries(self, port_info, now):
+        """Leave the failed devices not due for a retry out of port_info.
+
+        Retries of devices which no longer need processing are forgotten.
+        """
+        if not port_info:
+            self.retries.clear()
+            return
+        changed = port_info['added'] | port_info['removed']
+        for device in set(self.retries) - changed:
+            del self.retries[device]
+        held = set(device for device in changed
+                   if self.retries.get(device, (0, 0))[1] > now)
+        if not held:
+            return port_info
+        added = port_info['added'] - held
+        removed = port_info['removed'] - held
+        if not (added or removed):
+            return
+        return {'current': ((port_info['current'] - held) |
+                            (port_info['removed'] & held)),
+                'added': added,
+                'removed': removed}
+
+    def _schedule_retries(self, failed, now):
+        """Retry failed devices after an exponentially growing delay."""
+        for device in failed:
+            attempts = self.retries.get(device, (0, 0))[0] + 1
+            delay = min(self._polling_interval * 2 ** (attempts - 1),
+                        self._retry_max_interval)
+            LOG.debug(_("Retrying device %(device)s in %(delay)s seconds"),
+                      {'device': device, 'delay': delay})
+            self.retries[device] = (attempts, now + delay)
+
     def process_network_ports(self, port_info):
-        resync_a = False
-        resync_b = False
+        """Process the added and removed devices.
+
+        :returns: set of the devices which failed and must be processed
+                  again
+        """
+        failed = set()
         if port_info.get('added'):
             LOG.debug(_("ports added!"))
-            resync_a = self.treat_devices_added(port_info['added'])
+            failed |= self.treat_devices_added(port_info['added'])
         if port_info.get('removed'):
             LOG.debug(_("ports removed!"))
-            resync_b = self.treat_devices_removed(port_info['removed'])
-        # If one of the above opertaions fails => resync with plugin
-        return (resync_a | resync_b)
-
-    def treat_vif_port(self, port_id, port_mac,
-                       network_id, network_type,
-                       physical_network, segmentation_id,
-                       admin_state_up):
-        if self.eswitch.vnic_port_exists(port_mac):
-            if admin_state_up:
-                self.eswitch.port_up(network_id,
-                                     network_type,
-                                     physical_network,
-                                     segmentation_id,
-                                     port_id,
-                                     port_mac)
+            failed |= self.treat_devices_removed(port_info['removed'])
+        return failed
+
+    def _get_device_details(self, device):
+        try:
+            return self.plugin_rpc.get_device_details(self.context, device,
+                                                      self.agent_id)
+        except Exception as e:
+            LOG.debug(_("Unable to get device dev_details for device "
+                      "with mac_address %(device)s: due to %(exc)s"),
+                      {'device': device, 'exc': e})
+
+    def get_devices_details(self, devices):
+        """Get the details of the devices from the plugin.
+
+        Uses a single get_devices_details_list call, unless the plugin is
+        too old to support it. Then the devices are requested one by one,
+        concurrently on the agent's green pool.
+
+        :returns: tuple of the list of device details and the set of
+                  devices whose details could not be got
+        """
+        if self.devices_details_list_supported:
+            try:
+                return (self.plugin_rpc.get_devices_details_list(
+                    self.context, list(devices), self.agent_id), set())
+            except rpc_common.RemoteError as e:
+                if e.exc_type != 'UnsupportedRpcVersion':
+                    LOG.debug(_("Unable to get details of devices "
+                                "%(devices)s: due to %(exc)s"),
+                              {'devices': devices, 'exc': e})
+                    return [], set(devices)
+                LOG.info(_("Plugin does not support "
+                           "get_devices_details_list, requesting devices "
+                           "details one by one"))
+                self.devices_details_list_supported = False
+            except Exception as e:
+                LOG.debug(_("Unable to get details of devices "
+                            "%(devices)s: due to %(exc)s"),
+                          {'devices': devices, 'exc': e})
+                return [], set(devices)
+        devices = list(devices)
+        devices_details = []
+        failed = set()
+        for device, dev_details in zip(
+                devices, self.pool.imap(self._get_device_details, devices)):
+            if dev_details is None:
+                failed.add(device)
             else:
-                self.eswitch.port_down(network_id, physical_network, port_mac)
-        else:
-            LOG.debug(_("No port %s defined on agent."), port_id)
+                devices_details.append(dev_details)
+        return devices_details, failed
 
     def treat_devices_added(self, devices):
-        resync = False
-        for device in devices:
+        """Bind the added devices.
+
+        :returns: set of the devices which failed
+        """
+        all_details, failed = self.get_devices_details(devices)
+        devices_details = []
+        for dev_details in all_details:
+            device = dev_details['device']
             LOG.info(_("Adding port with mac %s"), device)
-            try:
-                dev_details = self.plugin_rpc.get_device_details(
-                    self.context,
-                    device,
-                    self.agent_id)
-            except Exception as e:
-                LOG.debug(_("Unable to get device dev_details for device "
-                          "with mac_address %(device)s: due to %(exc)s"),
-                          {'device': device, 'exc': e})
-                resync = True
-                continue
             if 'port_id' in dev_details:
                 LOG.info(_("Port %s updated"), device)
                 LOG.debug(_("Device details %s"), str(dev_details))
-                self.treat_vif_port(dev_details['port_id'],
-                                    dev_details['port_mac'],
-                                    dev_details['network_id'],
-                                    dev_details['network_type'],
-                                    dev_details['physical_network'],
-                                    dev_details['vlan_id'],
-                                    dev_details['admin_state_up'])
+                devices_details.append(dev_details)
             else:
                 LOG.debug(_("Device with mac_address %s not defined "
                           "on Neutron Plugin"), device)
-        return resync
+        if devices_details:
+            # vNICs may have gone away while waiting for the plugin
+            vnics = self.eswitch.get_vnics_mac()
+            attached = []
+            for dev_details in devices_details:
+                if dev_details['port_mac'] in vnics:
+                    attached.append(dev_details)
+                else:
+                    LOG.debug(_("No port %s defined on agent."),
+                              dev_details['port_id'])
+            failed |= self.eswitch.bind_ports(attached)
+        return failed
+
+    def update_devices_status(self, devices, up):
+        """Report devices up or down to the plugin.
+
+        Uses a single update_devices_up/down call, unless the plugin is
+        too old to support it. Then the devices are reported one by one,
+        concurrently on the agent's green pool.
+
+        :returns: the plugin answers for devices reported down
+        """
+        if self.devices_status_list_supported:
+            if up:
+                update_devices = self.plugin_rpc.update_devices_up
+            else:
+                update_devices = self.plugin_rpc.update_devices_down
+            try:
+                return update_devices(self.context, list(devices),
+                                      self.agent_id)
+            except rpc_common.RemoteError as e:
+                if e.exc_type != 'UnsupportedRpcVersion':
+                    raise
+                LOG.info(_("Plugin does not support update_devices_up/down,"
+                           " reporting devices status one by one"))
+                self.devices_status_list_supported = False
+        if up:
+            update_device = self.plugin_rpc.update_device_up
+        else:
+            update_device = self.plugin_rpc.update_device_down
+        return list(self.pool.imap(
+            lambda device: update_device(self.context, device,
+                                         self.agent_id),
+            devices))
+
+    def queue_device_status(self, device, up):
+        """Report device status to the plugin together with others."""
+        if not self.devices_status:
+            eventlet.spawn_after(DEVICES_STATUS_DELAY,
+                                 self._send_devices_status)
+        self.devices_status[device] = up
+
+    def _send_devices_status(self):
+        devices_status, self.devices_status = self.devices_status, {}
+        for up in (True, False):
+            devices = [device for device, device_up
+                       in devices_status.iteritems() if device_up == up]
+            if not devices:
+                continue
+            try:
+                self.update_devices_status(devices, up)
+            except Exception as e:
+                LOG.error(_("Failed to update status of devices "
+                            "%(devices)s: %(exc)s"),
+                          {'devices': devices, 'exc': e})
 
     def treat_devices_removed(self, devices):
-        resync = False
+        """Report the removed devices down and release them.
+
+        :returns: set of the devices which failed
+        """
+        port_ids = {}
         for device in devices:
             LOG.info(_("Removing device with mac_address %s"), device)
             try:
-                port_id = self.eswitch.get_port_id_by_mac(device)
-                dev_details = self.plugin_rpc.update_device_down(self.context,
-                                                                 port_id,
-                                                                 self.agent_id)
+                port_ids[device] = self.eswitch.get_port_id_by_mac(device)
             except Exception as e:
+                # the device was never bound, there is nothing to undo
                 LOG.debug(_("Removing port failed for device %(device)s "
                           "due to %(exc)s"), {'device': device, 'exc': e})
-                resync = True
-                continue
+        if not port_ids:
+            return set()
+        try:
+            devices_details = self.update_devices_status(port_ids.values(),
+                                                         up=False)
+        except Exception as e:
+            LOG.debug(_("Removing ports failed for devices %(devices)s "
+                      "due to %(exc)s"),
+                      {'devices': port_ids.keys(), 'exc': e})
+            return set(port_ids)
+        for dev_details in devices_details:
             if dev_details['exists']:
-                LOG.info(_("Port %s updated."), device)
+                LOG.info(_("Port %s updated."), dev_details['device'])
             else:
-                LOG.debug(_("Device %s not defined on plugin"), device)
-            self.eswitch.port_release(device)
-        return resync
+                LOG.debug(_("Device %s not defined on plugin"),
+                          dev_details['device'])
+        errors = self.eswitch.release_ports(port_ids)
+        for device, e in errors.iteritems():
+            LOG.debug(_("Releasing port failed for device %(device)s "
+                      "due to %(exc)s"), {'device': device, 'exc': e})
+        return set(errors)
+
+    def _load_state(self):
+        """Load the state saved by the last run of the agent.
+
+        Restores the eSwitch network and port maps.
+
+        :returns: the set of ports registered by the last run, or None if
+                  no usable state was saved
+        """
+        state_file = cfg.CONF.AGENT.state_file
+        if not state_file or not os.path.exists(state_file):
+            return
+        try:
+            with open(state_file) as f:
+                state = jsonutils.loads(f.read())
+            if state.get('version') != STATE_FILE_VERSION:
+                LOG.warning(_("Ignoring agent state file %(file)s of "
+                              "version %(version)s"),
+                            {'file': state_file,
+                             'version': state.get('version')})
+                return
+            self.eswitch.restore_state(state['eswitch'])
+            return set(state['ports'])
+        except Exception:
+            LOG.exception(_("Failed to load agent state from %s"),
+                          state_file)
+
+    def _save_state(self, ports):
+        """Save the registered ports and the eSwitch maps.
+
+        The state is written to a temporary file which then replaces the
+        state file, so the state file is always complete.
+        """
+        state_file = cfg.CONF.AGENT.state_file
+        if not state_file:
+            return
+        state = {'version': STATE_FILE_VERSION,
+                 'ports': list(ports),
+                 'eswitch': self.eswitch.get_state()}
+        tmp_file = '%s.tmp' % state_file
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(jsonutils.dumps(state))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_file, state_file)
+        except (IOError, OSError) as e:
+            LOG.error(_("Failed to save agent state to %(file)s: %(exc)s"),
+                      {'file': state_file, 'exc': e})
+
+    def _record_iteration(self, elapsed, interval, port_info, failed):
+        metrics = self.loop_metrics
+        metrics['iterations'] += 1
+        if elapsed > interval:
+            metrics['overruns'] += 1
+        if port_info:
+            metrics['devices_added'] += len(port_info['added'])
+            metrics['devices_removed'] += len(port_info['removed'])
+        metrics['devices_failed'] += len(failed)
+        for bound in LOOP_DURATION_BUCKETS:
+            if elapsed <= bound:
+                metrics['durations']['%s' % bound] += 1
+                return
+        metrics['durations']['inf'] += 1
 
     def daemon_loop(self):
-        sync = True
-        ports = set()
+        events = []
+        last_full_sync = 0
+        last_resync = None
+        interval = self._polling_interval
 
         LOG.info(_("eSwitch Agent Started!"))
 
+        # after a restart only reconcile the differences between the
+        # saved state and the attached vNICs
+        ports = self._load_state()
+        if ports is None:
+            ports = set()
+        else:
+            LOG.info(_("Restored state of %d devices"), len(ports))
+            last_resync = time.time()
+
         while True:
+            failure = False
+            port_info = None
+            failed = set()
             try:
                 start = time.time()
-                if sync:
-                    LOG.info(_("Agent out of sync with plugin!"))
+                if (last_resync is None or self._resync_interval and
+                        start - last_resync >= self._resync_interval):
+                    LOG.info(_("Resyncing all devices with plugin"))
                     ports.clear()
-                    sync = False
-
-                port_info = self.update_ports(ports)
+                    # program the eSwitch again, it may have lost its state
+                    self.eswitch.programmed.clear()
+                    self.eswitch.vnics_generation = None
+                    self.retries.clear()
+                    last_full_sync = 0
+                    last_resync = start
+
+                if (self.vnic_events is None or
+                        start - last_full_sync >= self._full_sync_interval):
+                    port_info = self.update_ports(ports)
+                    last_full_sync = start
+                else:
+                    port_info = self.update_ports_from_events(ports, events)
+                port_info = self._hold_back_retries(port_info, start)
                 # notify plugin about port deltas
                 if port_info:
                     LOG.debug(_("Agent loop process devices!"))
-                    # If treat devices fails - must resync with plugin
-                    sync = self.process_network_ports(port_info)
-                    ports = port_info['current']
+                    failed = self.process_network_ports(port_info)
+                    self._schedule_retries(failed, time.time())
+                    # failed devices are processed again when retried:
+                    # added ones are left out of the registered ports and
+                    # removed ones are kept in them
+                    ports = ((port_info['current'] - failed) |
+                             (failed - port_info['current']))
+                if port_info or self.eswitch.state_changed:
+                    self._save_state(ports)
             except Exception:
                 LOG.exception(_("Error in agent event loop"))
-                sync = True
-            # sleep till end of polling interval
+                failure = True
             elapsed = (time.time() - start)
-            if (elapsed < self._polling_interval):
-                time.sleep(self._polling_interval - elapsed)
+            self._record_iteration(elapsed, interval, port_info, failed)
+            # poll often while devices change or fail, less when idle
+            if failure or port_info or self.retries:
+                interval = self._polling_interval
+            else:
+                interval = min(interval * 2, self._max_polling_interval)
+            if self.vnic_events is not None:
+                # wait for vNIC events till the next full sync or retry
+                if failure:
+                    timeout = self._polling_interval
+                else:
+                    deadline = last_full_sync + self._full_sync_interval
+                    if self.retries:
+                        deadline = min([deadline] +
+                                       [retry for attempts, retry
+                                        in self.retries.itervalues()])
+                    timeout = deadline - time.time()
+                events = self._wait_for_vnic_events(max(timeout, 0))
+            # sleep till end of polling interval
+            elif (elapsed < interval):
+                time.sleep(interval - elapsed)
             else:
                 LOG.debug(_("Loop iteration exceeded interval "
                             "(%(polling_interval)s vs. %(elapsed)s)"),
-                          {'polling_interval': self._polling_interval,
+                          {'polling_interval': interval,
                            'elapsed': elapsed})
 
 
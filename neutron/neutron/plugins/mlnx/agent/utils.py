@@ -15,7 +15,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import itertools
+import time
+
+import eventlet
+from eventlet import event
+from eventlet.green import zmq as green_zmq
+from eventlet import semaphore
 import zmq
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 from neutron.openstack.common import jsonutils
 from neutron.openstack.common import log as logging
@@ -23,42 +35,355 @@ from neutron.plugins.mlnx.common import exceptions
 
 LOG = logging.getLogger(__name__)
 
+# vNIC events published by eSwitchD
+VNIC_ATTACHED = 'attach'
+VNIC_DETACHED = 'detach'
+
+# seconds requests fail fast once eSwitchD is considered down, doubled
+# with every reconnection which times out again
+RECONNECT_INTERVAL = 1
+
+# reason of the failure of actions eSwitchD does not know
+UNKNOWN_ACTION = 'unknown action'
+
+
+class JsonCodec(object):
+    """Wire format understood by every eSwitchD."""
+
+    name = 'json'
+
+    def encode(self, msg):
+        return jsonutils.dumps(msg)
+
+    def decode(self, data):
+        return jsonutils.loads(data)
+
+
+class MsgpackCodec(object):
+    """Compact binary wire format, decoded to the same types as JSON."""
+
+    name = 'msgpack'
+
+    def encode(self, msg):
+        return msgpack.packb(msg)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+JSON_CODEC = JsonCodec()
+CODECS = dict((codec.name, codec)
+              for codec in (JSON_CODEC, MsgpackCodec()))
+
+
+def get_codecs(names):
+    """Get the usable codecs out of the given names.
+
+    JSON is always added last, as the fallback for old daemons.
+    """
+    codecs = []
+    for name in names:
+        codec = CODECS.get(name)
+        if codec is None:
+            LOG.warning(_("Unknown eSwitchD wire codec %s"), name)
+        elif codec.name == 'msgpack' and msgpack is None:
+            LOG.warning(_("msgpack is not installed, not using it to talk "
+                          "to eSwitchD"))
+        elif codec not in codecs:
+            codecs.append(codec)
+    if JSON_CODEC not in codecs:
+        codecs.append(JSON_CODEC)
+    return codecs
+
+
+def set_vlan_msg(physical_network, segmentation_id, port_mac):
+    return {'action': 'set_vlan',
+            'fabric': physical_network,
+            'port_mac': port_mac,
+            'vlan': segmentation_id}
+
+
+def fabric_mapping_msg(fabric, phy_interface):
+    return {'action': 'define_fabric_mapping',
+            'fabric': fabric,
+            'interface': phy_interface}
+
+
+def port_up_msg(fabric, port_mac):
+    return {'action': 'port_up',
+            'fabric': fabric,
+            'ref_by': 'mac_address',
+            'mac': port_mac}
+
+
+def port_down_msg(fabric, port_mac):
+    return {'action': 'port_down',
+            'fabric': fabric,
+            'ref_by': 'mac_address',
+            'mac': port_mac}
+
+
+def port_release_msg(fabric, port_mac):
+    return {'action': 'port_release',
+            'fabric': fabric,
+            'ref_by': 'mac_address',
+            'mac': port_mac}
+
+
+class EswitchRequest(object):
+    """Handle of a request sent to eSwitchD and not yet answered."""
+
+    def __init__(self, client, msg_id, action, timeout, probe=False):
+        self.client = client
+        self.msg_id = msg_id
+        self.action = action
+        # whether the action may be unknown to the daemon
+        self.probe = probe
+        self.deadline = time.time() + timeout / 1000.0
+        self.event = event.Event()
+
+    def ready(self):
+        return self.event.ready()
+
+    def wait(self):
+        """Block until the daemon answers and return its response.
+
+        Raises MlnxException if the action failed or timed out.
+        """
+        if not self.event.ready():
+            self.client.wait_for(self)
+        return self.event.wait()
+
 
 class EswitchUtils(object):
-    def __init__(self, daemon_endpoint, timeout):
+    """Client of the eSwitch daemon.
+
+    Requests go over a DEALER socket and are tagged with a msg_id, so many
+    of them may be in flight at once. Replies are matched back by msg_id,
+    or in send order for daemons which do not echo it (REP answers in
+    order). The socket is green: waiting for a reply yields to the other
+    greenthreads, and one waiter at a time receives the replies of all
+    of them.
+
+    A timed out socket is replaced, but not the ZMQ context which is
+    shared by the process. After failure_threshold timeouts in a row
+    eSwitchD is considered down: requests fail at once instead of waiting
+    for the timeout, until a new connection is tried after a delay which
+    doubles up to reconnect_max_interval seconds while eSwitchD does not
+    answer.
+
+    Messages are JSON encoded, unless a more compact codec is agreed on
+    with the daemon by a negotiate_codec request on each new connection.
+    Daemons which do not support it are talked to in JSON.
+    """
+
+    def __init__(self, daemon_endpoint, timeout, failure_threshold=3,
+                 reconnect_max_interval=30, codecs=('msgpack', 'json')):
         self.__conn = None
+        self.__events = None
         self.daemon = daemon_endpoint
         self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reconnect_max_interval = reconnect_max_interval
+        # timeouts since eSwitchD last answered
+        self.failures = 0
+        # when to connect again while eSwitchD is considered down
+        self._reconnect_at = 0
+        self._msg_ids = itertools.count(1)
+        self._pending = collections.OrderedDict()
+        # whether a greenthread is receiving replies, and the event sent
+        # when it dispatched some or stopped receiving
+        self._receiving = False
+        self._received = event.Event()
+        self._negotiation = semaphore.Semaphore()
+        self.batch_supported = True
+        self.vnics_delta_supported = True
+        self.codecs = get_codecs(codecs)
+        # codec agreed on with the daemon, None until negotiated
+        self.codec = None
 
     @property
     def _conn(self):
         if self.__conn is None:
-            context = zmq.Context()
-            socket = context.socket(zmq.REQ)
+            socket = green_zmq.Context.instance().socket(zmq.DEALER)
             socket.setsockopt(zmq.LINGER, 0)
             socket.connect(self.daemon)
             self.__conn = socket
-            self.poller = zmq.Poller()
-            self.poller.register(self._conn, zmq.POLLIN)
         return self.__conn
 
-    def send_msg(self, msg):
-        self._conn.send(msg)
+    def _reset_conn(self):
+        self.__conn.setsockopt(zmq.LINGER, 0)
+        self.__conn.close()
+        self.__conn = None
+        self.codec = None
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            delay = min(RECONNECT_INTERVAL *
+                        2 ** (self.failures - self.failure_threshold),
+                        self.reconnect_max_interval)
+            self._reconnect_at = time.time() + delay
+            LOG.warning(_("eSwitchD did not answer %(failures)d requests, "
+                          "failing requests for %(delay)s seconds"),
+                        {'failures': self.failures, 'delay': delay})
+        # replies to requests sent on the old socket will never arrive
+        pending, self._pending = self._pending, collections.OrderedDict()
+        for request in pending.itervalues():
+            request.event.send_exception(
+                exceptions.MlnxException(
+                    err_msg=_("eSwitchD: Request timeout")))
+
+    def available(self):
+        """Whether requests are sent to eSwitchD or fail at once."""
+        return (self.failures < self.failure_threshold or
+                time.time() >= self._reconnect_at)
+
+    def send_msg_async(self, msg, probe=False):
+        """Send a request without waiting for the reply.
+
+        :param msg: request dict, it is tagged with a msg_id
+        :param probe: whether the action may be unknown to the daemon,
+                      which is then not logged as an error
+        :returns: EswitchRequest to wait on for the response
+        """
+        error = None
+        if not self.available():
+            error = exceptions.MlnxException(
+                err_msg=_("eSwitchD is not available"))
+        elif self.codec is None:
+            try:
+                self._negotiate_codec()
+            except exceptions.MlnxException as e:
+                error = e
+        return self._send_request(msg, self.codec, error, probe)
+
+    def _send_request(self, msg, codec, error=None, probe=False):
+        msg_id = self._msg_ids.next()
+        msg['msg_id'] = msg_id
+        request = EswitchRequest(self, msg_id, msg.get('action'),
+                                 self.timeout, probe)
+        if error is not None:
+            request.event.send_exception(error)
+            return request
+        # empty delimiter frame, as REP/ROUTER peers expect from a REQ
+        self._conn.send_multipart(['', codec.encode(msg)])
+        self._pending[msg_id] = request
+        return request
+
+    def _negotiate_codec(self):
+        """Agree with the daemon on the codec of the next messages.
+
+        Other greenthreads sending meanwhile wait for the negotiation,
+        as the daemon decodes the messages after its reply with the
+        codec agreed on.
+        """
+        with self._negotiation:
+            if self.codec is not None:
+                return
+            if self.codecs == [JSON_CODEC]:
+                self.codec = JSON_CODEC
+                return
+            # the negotiation itself is in JSON
+            try:
+                name = self._send_request(
+                    {'action': 'negotiate_codec',
+                     'codecs': [codec.name for codec in self.codecs]},
+                    JSON_CODEC, probe=True).wait()
+            except exceptions.MlnxActionUnsupported:
+                LOG.debug(_("eSwitchD does not support codec negotiation, "
+                            "using JSON"))
+                self.codec = JSON_CODEC
+                return
+            except exceptions.MlnxActionFailed:
+                self.codec = JSON_CODEC
+                return
+            codec = CODECS.get(name)
+            if codec in self.codecs:
+                self.codec = codec
+            else:
+                LOG.warning(_("eSwitchD chose unknown codec %s, using "
+                              "JSON"), name)
+                self.codec = JSON_CODEC
+            LOG.debug(_("Using %s codec with eSwitchD"), self.codec.name)
+
+    def send_msg(self, msg, probe=False):
+        return self.send_msg_async(msg, probe).wait()
+
+    def wait_for(self, request):
+        """Receive replies until the given request is answered.
+
+        While another greenthread receives, wait for it to dispatch the
+        reply instead.
+        """
+        timeout = eventlet.Timeout(max(request.deadline - time.time(), 0))
+        try:
+            while not request.ready():
+                if self._receiving:
+                    self._received.wait()
+                    continue
+                self._receiving = True
+                try:
+                    self._recv_replies(self._conn)
+                finally:
+                    self._receiving = False
+                    received, self._received = self._received, event.Event()
+                    received.send()
+        except eventlet.Timeout as e:
+            if e is not timeout:
+                raise
+            if not request.ready():
+                self._reset_conn()
+        finally:
+            timeout.cancel()
 
-        socks = dict(self.poller.poll(self.timeout))
-        if socks.get(self._conn) == zmq.POLLIN:
-            recv_msg = self._conn.recv()
-            response = self.parse_response_msg(recv_msg)
-            return response
+    def _recv_replies(self, conn):
+        """Wait for a reply, then dispatch all those received."""
+        flags = 0
+        while True:
+            try:
+                frames = conn.recv_multipart(flags)
+            except zmq.Again:
+                return
+            except zmq.ZMQError:
+                if conn is self.__conn:
+                    raise
+                # the socket was reset, failing the pending requests
+                return
+            flags = zmq.NOBLOCK
+            if self.failures >= self.failure_threshold:
+                LOG.info(_("eSwitchD is available again"))
+            self.failures = 0
+            self._dispatch_reply(frames[-1])
+
+    def _dispatch_reply(self, recv_msg):
+        msg = (self.codec or JSON_CODEC).decode(recv_msg)
+        if 'msg_id' in msg:
+            request = self._pending.pop(msg['msg_id'], None)
+            if request is None:
+                LOG.debug(_("Dropping stale eSwitchD reply %s"),
+                          msg['msg_id'])
+                return
+        elif self._pending:
+            msg_id, request = self._pending.popitem(last=False)
         else:
-            self._conn.setsockopt(zmq.LINGER, 0)
-            self._conn.close()
-            self.poller.unregister(self._conn)
-            self.__conn = None
-            raise exceptions.MlnxException(_("eSwitchD: Request timeout"))
+            LOG.warning(_("Unexpected reply from eSwitchD: %s"), msg)
+            return
+        try:
+            request.event.send(self.parse_response(msg, request.probe))
+        except exceptions.MlnxException as e:
+            request.event.send_exception(e)
 
     def parse_response_msg(self, recv_msg):
-        msg = jsonutils.loads(recv_msg)
+        return self.parse_response((self.codec or JSON_CODEC).decode(
+            recv_msg))
+
+    def parse_response(self, msg, probe=False):
+        """Get the response of an action, or raise its failure.
+
+        :param probe: whether the action may be unknown to the daemon,
+                      which is then logged at debug level
+        :raises: MlnxActionUnsupported if the daemon does not know the
+                 action, MlnxActionFailed if it failed
+        """
         if msg['status'] == 'OK':
             if 'response' in msg:
                 return msg.get('response')
@@ -66,66 +391,156 @@ class EswitchUtils(object):
         elif msg['status'] == 'FAIL':
             msg_dict = dict(action=msg['action'], reason=msg['reason'])
             error_msg = _("Action %(action)s failed: %(reason)s") % msg_dict
+            if msg['reason'] == UNKNOWN_ACTION:
+                if probe:
+                    LOG.debug(error_msg)
+                else:
+                    LOG.error(error_msg)
+                raise exceptions.MlnxActionUnsupported(err_msg=error_msg)
+            LOG.error(error_msg)
+            raise exceptions.MlnxActionFailed(err_msg=error_msg)
         else:
             error_msg = _("Unknown operation status %s") % msg['status']
         LOG.error(error_msg)
-        raise exceptions.MlnxException(error_msg)
+        raise exceptions.MlnxException(err_msg=error_msg)
+
+    def _send(self, msg, wait):
+        request = self.send_msg_async(msg)
+        if wait:
+            return request.wait()
+        return request
+
+    def batch(self, msgs):
+        """Send several actions to eSwitchD in a single request.
+
+        Falls back to pipelined single requests if the daemon does not
+        know the batch action. The actions the daemon did not answer in
+        the batch fail.
+
+        :param msgs: list of action dicts
+        :returns: list of EswitchRequest, one per action and in the same
+                  order, each holding the status of its action
+        """
+        if not msgs:
+            return []
+        if not self.batch_supported:
+            return [self.send_msg_async(msg) for msg in msgs]
+        LOG.debug(_("Sending batch of %d actions"), len(msgs))
+        try:
+            responses = self.send_msg({'action': 'batch', 'ops': msgs},
+                                      probe=True)
+        except exceptions.MlnxActionUnsupported:
+            LOG.info(_("eSwitchD does not support batch requests, "
+                       "sending actions one by one"))
+            self.batch_supported = False
+            return self.batch(msgs)
+        except exceptions.MlnxActionFailed as e:
+            responses = []
+            error = e
+        else:
+            responses = responses or []
+            error = exceptions.MlnxException(
+                err_msg=_("eSwitchD did not answer the action in a batch"))
+            if len(responses) != len(msgs):
+                LOG.error(_("eSwitchD answered %(replies)d of the "
+                            "%(count)d actions of a batch"),
+                          {'replies': len(responses), 'count': len(msgs)})
+        requests = []
+        for i, msg in enumerate(msgs):
+            request = EswitchRequest(self, None, msg['action'], self.timeout)
+            try:
+                if i >= len(responses):
+                    raise error
+                request.event.send(self.parse_response(responses[i]))
+            except exceptions.MlnxException as e:
+                request.event.send_exception(e)
+            requests.append(request)
+        return requests
 
-    def get_attached_vnics(self):
+    def get_attached_vnics(self, wait=True):
         LOG.debug(_("get_attached_vnics"))
-        msg = jsonutils.dumps({'action': 'get_vnics', 'fabric': '*'})
-        vnics = self.send_msg(msg)
-        return vnics
+        return self._send({'action': 'get_vnics', 'fabric': '*'}, wait)
+
+    def get_vnics_delta(self, generation):
+        """Get the vNICs attached and detached since a generation.
+
+        eSwitchD numbers the changes of its vNICs with generations. It
+        answers with the full snapshot of the attached vNICs when it does
+        not know the changes since the given generation, e.g. after a
+        restart. Falls back to full snapshots if the daemon does not
+        support deltas.
+
+        :param generation: generation returned by the previous call, or
+                           None to get a full snapshot
+        :returns: dict with the current 'generation' and either the
+                  'added' vNICs map and the 'removed' MACs, or the full
+                  'vnics' map
+        """
+        if self.vnics_delta_supported:
+            LOG.debug(_("get_vnics_delta since generation %s"), generation)
+            try:
+                return self.send_msg({'action': 'get_vnics_delta',
+                                      'fabric': '*',
+                                      'generation': generation},
+                                     probe=True)
+            except exceptions.MlnxActionUnsupported:
+                LOG.info(_("eSwitchD does not support vNICs deltas, "
+                           "getting all vNICs at every poll"))
+                self.vnics_delta_supported = False
+        return {'generation': None, 'vnics': self.get_attached_vnics()}
 
     def set_port_vlan_id(self, physical_network,
-                         segmentation_id, port_mac):
+                         segmentation_id, port_mac, wait=True):
         LOG.debug(_("Set Vlan  %(segmentation_id)s on Port %(port_mac)s "
                     "on Fabric %(physical_network)s"),
                   {'port_mac': port_mac,
                    'segmentation_id': segmentation_id,
                    'physical_network': physical_network})
-        msg = jsonutils.dumps({'action': 'set_vlan',
-                               'fabric': physical_network,
-                               'port_mac': port_mac,
-                               'vlan': segmentation_id})
-        self.send_msg(msg)
+        return self._send(set_vlan_msg(physical_network, segmentation_id,
+                                       port_mac), wait)
 
     def define_fabric_mappings(self, interface_mapping):
+        msgs = []
         for fabric, phy_interface in interface_mapping.iteritems():
             LOG.debug(_("Define Fabric %(fabric)s on interface %(ifc)s"),
                       {'fabric': fabric,
                        'ifc': phy_interface})
-            msg = jsonutils.dumps({'action': 'define_fabric_mapping',
-                                   'fabric': fabric,
-                                   'interface': phy_interface})
-            self.send_msg(msg)
+            msgs.append(fabric_mapping_msg(fabric, phy_interface))
+        for request in self.batch(msgs):
+            request.wait()
 
-    def port_up(self, fabric, port_mac):
+    def port_up(self, fabric, port_mac, wait=True):
         LOG.debug(_("Port Up for %(port_mac)s on fabric %(fabric)s"),
                   {'port_mac': port_mac, 'fabric': fabric})
-        msg = jsonutils.dumps({'action': 'port_up',
-                               'fabric': fabric,
-                               'ref_by': 'mac_address',
-                               'mac': 'port_mac'})
-        self.send_msg(msg)
+        return self._send(port_up_msg(fabric, port_mac), wait)
 
-    def port_down(self, fabric, port_mac):
+    def port_down(self, fabric, port_mac, wait=True):
         LOG.debug(_("Port Down for %(port_mac)s on fabric %(fabric)s"),
                   {'port_mac': port_mac, 'fabric': fabric})
-        msg = jsonutils.dumps({'action': 'port_down',
-                               'fabric': fabric,
-                               'ref_by': 'mac_address',
-                               'mac': port_mac})
-        self.send_msg(msg)
+        return self._send(port_down_msg(fabric, port_mac), wait)
 
-    def port_release(self, fabric, port_mac):
+    def port_release(self, fabric, port_mac, wait=True):
         LOG.debug(_("Port Release for %(port_mac)s on fabric %(fabric)s"),
                   {'port_mac': port_mac, 'fabric': fabric})
-        msg = jsonutils.dumps({'action': 'port_release',
-                               'fabric': fabric,
-                               'ref_by': 'mac_address',
-                               'mac': port_mac})
-        self.send_msg(msg)
+        return self._send(port_release_msg(fabric, port_mac), wait)
+
+    def subscribe_vnic_events(self, events_endpoint):
+        """Subscribe to the vNIC events published by eSwitchD."""
+        LOG.debug(_("Subscribing to vNIC events on %s"), events_endpoint)
+        socket = green_zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, '')
+        socket.connect(events_endpoint)
+        self.__events = socket
+
+    def recv_vnic_event(self):
+        """Wait for the next vNIC event.
+
+        Only the calling greenthread is blocked.
+
+        :returns: dict with the 'event' (VNIC_ATTACHED or VNIC_DETACHED)
+                  and the vNIC 'mac'
+        """
+        return jsonutils.loads(self.__events.recv())
 
     def get_eswitch_ports(self, fabric):
         # TODO(irena) - to implement for next phase
@@ -14,10 +14,13 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import eventlet
 from oslo.config import cfg
 
 from neutron.agent import securitygroups_rpc as sg_rpc
 from neutron.common import topics
+from neutron import context as q_context
+from neutron.extensions import portbindings
 from neutron.openstack.common import log as logging
 from neutron.openstack.common.rpc import proxy
 
@@ -32,6 +35,7 @@ class AgentNotifierApi(proxy.RpcProxy,
        1.0 - Initial version.
        1.1 - Added get_active_networks_info, create_dhcp_port,
               and update_dhcp_port methods.
+       1.2 - Added ports_update, cast to the agent of a single host.
     """
     BASE_RPC_API_VERSION = '1.1'
 
@@ -45,6 +49,8 @@ class AgentNotifierApi(proxy.RpcProxy,
         self.topic_port_update = topics.get_topic_name(topic,
                                                        topics.PORT,
                                                        topics.UPDATE)
+        # host -> {port_id: port_update arguments} not sent yet
+        self.pending_port_updates = {}
 
     def network_delete(self, context, network_id):
         LOG.debug(_("Sending delete network message"))
@@ -55,13 +61,49 @@ class AgentNotifierApi(proxy.RpcProxy,
 
     def port_update(self, context, port, physical_network,
                     network_type, vlan_id):
-        LOG.debug(_("Sending update port message"))
         kwargs = {'port': port,
                   'network_type': network_type,
                   'physical_network': physical_network,
                   'segmentation_id': vlan_id}
         if cfg.CONF.AGENT.rpc_support_old_agents:
             kwargs['vlan_id'] = vlan_id
+        host = (cfg.CONF.MLNX.port_update_to_host and
+                port.get(portbindings.HOST_ID))
+        if host:
+            self._queue_port_update(host, port['id'], kwargs)
+            return
+        LOG.debug(_("Sending update port message"))
         msg = self.make_msg('port_update', **kwargs)
         self.fanout_cast(context, msg,
                          topic=self.topic_port_update)
+
+    def _queue_port_update(self, host, port_id, kwargs):
+        """Queue a port update to be sent to its host with others.
+
+        Updates queued within port_update_delay seconds are sent in one
+        ports_update message per host, and only the last update of a
+        port is kept. As they come from several requests, they are sent
+        with an admin context.
+        """
+        if not self.pending_port_updates:
+            eventlet.spawn_after(cfg.CONF.MLNX.port_update_delay,
+                                 self._send_port_updates)
+        ports = self.pending_port_updates.setdefault(host, {})
+        ports[port_id] = kwargs
+
+    def _send_port_updates(self):
+        pending, self.pending_port_updates = self.pending_port_updates, {}
+        context = q_context.get_admin_context_without_session()
+        for host, ports in pending.iteritems():
+            LOG.debug(_("Sending update of %(count)d ports to host "
+                        "%(host)s"), {'count': len(ports), 'host': host})
+            try:
+                self.cast(context,
+                          self.make_msg('ports_update',
+                                        ports=ports.values()),
+                          topic='%s.%s' % (self.topic_port_update, host),
+                          version='1.2')
+            except Exception:
+                LOG.exception(_("Failed to send update of ports "
+                                "%(port_ids)s to host %(host)s"),
+                              {'port_ids': ports.keys(), 'host': host})
@@ -31,6 +31,19 @@ vlan_opts = [
                 default=DEFAULT_VLAN_RANGES,
                 help=_("List of <physical_network>:<vlan_min>:<vlan_max> "
                        "or <physical_network>")),
+    cfg.IntOpt('network_binding_cache_size', default=10000,
+               help=_("The maximum number of network bindings cached by "
+                      "the server. 0 disables the cache.")),
+    cfg.IntOpt('network_binding_cache_ttl', default=300,
+               help=_("The number of seconds a network binding stays "
+                      "cached.")),
+    cfg.BoolOpt('port_update_to_host', default=False,
+                help=_("Send port updates only to the agent on the host "
+                       "the port is bound to, instead of to all agents. "
+                       "All agents must support ports_update.")),
+    cfg.FloatOpt('port_update_delay', default=0.1,
+                 help=_("The number of seconds port updates to the same "
+                        "host are held to be sent in one message.")),
 ]
 
 
@@ -48,12 +61,57 @@ eswitch_opts = [
     cfg.IntOpt('request_timeout', default=3000,
                help=_("The number of milliseconds the agent will wait for "
                       "response on request to daemon.")),
+    cfg.StrOpt('vnic_events_endpoint',
+               help=_('eswitch daemon vNIC events publisher end point')),
+    cfg.IntOpt('failure_threshold', default=3,
+               help=_("The number of requests to the daemon in a row "
+                      "which time out before the agent fails requests "
+                      "at once instead of waiting for the daemon.")),
+    cfg.IntOpt('reconnect_max_interval', default=30,
+               help=_("The maximum number of seconds between the agent's "
+                      "attempts to connect again to a daemon which does "
+                      "not answer.")),
+    cfg.ListOpt('wire_codecs', default=['msgpack', 'json'],
+                help=_("List of the codecs to encode messages to the daemon "
+                       "with, by order of preference. The daemon picks "
+                       "one, JSON is used with daemons which do not.")),
 ]
 
 agent_opts = [
     cfg.IntOpt('polling_interval', default=2,
                help=_("The number of seconds the agent will wait between "
                       "polling for local device changes.")),
+    cfg.IntOpt('max_polling_interval', default=0,
+               help=_("The maximum number of seconds the agent waits "
+                      "between polls when no local device changes. The "
+                      "wait doubles from polling_interval with every idle "
+                      "poll. New ports may then be bound this late. "
+                      "Values up to polling_interval disable the "
+                      "backoff.")),
+    cfg.IntOpt('full_sync_interval', default=30,
+               help=_("The number of seconds between full syncs of the local "
+                      "devices when vNIC events are received from the "
+                      "daemon.")),
+    cfg.IntOpt('retry_max_interval', default=60,
+               help=_("The maximum number of seconds the agent waits "
+                      "before processing a failed device again. The wait "
+                      "starts at polling_interval and doubles with every "
+                      "failure.")),
+    cfg.IntOpt('resync_interval', default=3600,
+               help=_("The number of seconds between resyncs of all local "
+                      "devices with the plugin. 0 disables them.")),
+    cfg.IntOpt('vnics_max_age', default=60,
+               help=_("The number of seconds the agent uses its snapshot of "
+                      "the attached vNICs for RPC callbacks and state "
+                      "reports before asking the daemon again.")),
+    cfg.IntOpt('device_workers', default=8,
+               help=_("The number of devices the agent processes "
+                      "concurrently when it has to handle them one by "
+                      "one.")),
+    cfg.StrOpt('state_file', default='$state_path/mlnx_agent_state.json',
+               help=_("File where the agent saves its local device state, "
+                      "so that a restarted agent only reconciles changed "
+                      "devices. Empty disables it.")),
     cfg.BoolOpt('rpc_support_old_agents', default=True,
                 help=_("Enable server RPC compatibility with old agents")),
 ]
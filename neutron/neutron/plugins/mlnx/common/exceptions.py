@@ -20,3 +20,11 @@ from neutron.common import exceptions as qexc
 
 class MlnxException(qexc.NeutronException):
     message = _("Mlnx Exception: %(err_msg)s")
+
+
+class MlnxActionFailed(MlnxException):
+    message = _("eSwitchD action failed: %(err_msg)s")
+
+
+class MlnxActionUnsupported(MlnxActionFailed):
+    message = _("eSwitchD action not supported: %(err_msg)s")
@@ -15,6 +15,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import random
+import time
+
+from oslo.config import cfg
+import sqlalchemy as sa
 from sqlalchemy.orm import exc
 
 from neutron.common import exceptions as q_exc
@@ -31,45 +37,127 @@ LOG = logging.getLogger(__name__)
 
 def initialize():
     db.configure_db()
+    network_binding_cache.configure(cfg.CONF.MLNX.network_binding_cache_size,
+                                    cfg.CONF.MLNX.network_binding_cache_ttl)
+
+
+NetworkState = collections.namedtuple('NetworkState',
+                                      ['physical_network',
+                                       'segmentation_id',
+                                       'allocated'])
+
+BLOCK_SIZE = mlnx_models_v2.SEGMENTATION_ID_BLOCK_SIZE
+
+# length of a port id, which is a UUID string
+PORT_ID_LENGTH = 36
+
+# seconds between two logs of the network binding cache statistics
+CACHE_STATS_LOG_INTERVAL = 300
+
+NetworkBindingInfo = collections.namedtuple('NetworkBindingInfo',
+                                            ['network_id',
+                                             'network_type',
+                                             'physical_network',
+                                             'segmentation_id'])
+
+
+class NetworkBindingCache(object):
+    """LRU cache of network bindings, which never change once created.
+
+    Entries expire after ttl seconds, so a binding removed by another
+    server process is not used for long. The hit and miss counts are
+    logged at debug level every CACHE_STATS_LOG_INTERVAL seconds.
+    """
+
+    def __init__(self, size=0, ttl=0):
+        self._entries = collections.OrderedDict()
+        self._log_stats_at = 0
+        self.configure(size, ttl)
+
+    def configure(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, network_id):
+        now = time.time()
+        if self.size > 0 and now >= self._log_stats_at:
+            self._log_stats_at = now + CACHE_STATS_LOG_INTERVAL
+            LOG.debug(_("Network binding cache holds %(size)d entries, "
+                        "%(hits)d hits and %(misses)d misses"),
+                      self.stats())
+        entry = self._entries.pop(network_id, None)
+        if entry and entry[0] > now:
+            # re-insert to keep the most recently used entries last
+            self._entries[network_id] = entry
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+
+    def add(self, binding):
+        if self.size <= 0:
+            return
+        info = NetworkBindingInfo(binding.network_id, binding.network_type,
+                                  binding.physical_network,
+                                  binding.segmentation_id)
+        self._entries.pop(info.network_id, None)
+        self._entries[info.network_id] = (time.time() + self.ttl, info)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return info
+
+    def invalidate(self, network_id):
+        self._entries.pop(network_id, None)
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+network_binding_cache = NetworkBindingCache()
+
+
+def _bitmap(value):
+    return int(value, 16)
+
+
+def _hex(bitmap):
+    return '%x' % bitmap
+
+
+def _count_bits(bitmap):
+    return bin(bitmap).count('1')
+
+
+def _block_first_id(segmentation_id):
+    return segmentation_id - segmentation_id % BLOCK_SIZE
+
+
+def _range_bitmap(first_id, vlan_min, vlan_max):
+    """Get bitmap of the part of a VLAN range inside a block."""
+    low = max(vlan_min, first_id) - first_id
+    high = min(vlan_max, first_id + BLOCK_SIZE - 1) - first_id
+    return ((1 << (high - low + 1)) - 1) << low
+
+
+def _update_free_count(block):
+    free = _bitmap(block.allocatable) & ~_bitmap(block.allocated)
+    block.free_count = _count_bits(free)
 
 
-def _remove_non_allocatable_vlans(session, allocations,
-                                  physical_network, vlan_ids):
-    if physical_network in allocations:
-        for entry in allocations[physical_network]:
-            try:
-                # see if vlan is allocatable
-                vlan_ids.remove(entry.segmentation_id)
-            except KeyError:
-                # it's not allocatable, so check if its allocated
-                if not entry.allocated:
-                    # it's not, so remove it from table
-                    LOG.debug(_(
-                        "Removing vlan %(seg_id)s on "
-                        "physical network "
-                        "%(net)s from pool"),
-                        {'seg_id': entry.segmentation_id,
-                         'net': physical_network})
-                    session.delete(entry)
-        del allocations[physical_network]
-
-
-def _add_missing_allocatable_vlans(session, physical_network, vlan_ids):
-    for vlan_id in sorted(vlan_ids):
-        entry = mlnx_models_v2.SegmentationIdAllocation(physical_network,
-                                                        vlan_id)
-        session.add(entry)
-
-
-def _remove_unconfigured_vlans(session, allocations):
-    for entries in allocations.itervalues():
-        for entry in entries:
-            if not entry.allocated:
-                LOG.debug(_("removing vlan %(seg_id)s on physical "
-                            "network %(net)s from pool"),
-                          {'seg_id': entry.segmentation_id,
-                           'net': entry.physical_network})
-                session.delete(entry)
+def _get_block(session, physical_network, segmentation_id):
+    return (session.query(mlnx_models_v2.SegmentationIdBlock).
+            filter_by(physical_network=physical_network,
+                      first_id=_block_first_id(segmentation_id)).
+            with_lockmode('update').
+            populate_existing().
+            first())
 
 
 def sync_network_states(network_vlan_ranges):
@@ -77,116 +165,183 @@ def sync_network_states(network_vlan_ranges):
 
     session = db.get_session()
     with session.begin():
-        # get existing allocations for all physical networks
-        allocations = dict()
-        entries = (session.query(mlnx_models_v2.SegmentationIdAllocation).
-                   all())
-        for entry in entries:
-            allocations.setdefault(entry.physical_network, set()).add(entry)
-
-        # process vlan ranges for each configured physical network
+        # get bitmaps of the configured allocatable vlans per block
+        allocatable = {}
         for physical_network, vlan_ranges in network_vlan_ranges.iteritems():
-            # determine current configured allocatable vlans for this
-            # physical network
-            vlan_ids = set()
-            for vlan_range in vlan_ranges:
-                vlan_ids |= set(xrange(vlan_range[0], vlan_range[1] + 1))
+            for vlan_min, vlan_max in vlan_ranges:
+                for first_id in xrange(_block_first_id(vlan_min),
+                                       vlan_max + 1, BLOCK_SIZE):
+                    key = (physical_network, first_id)
+                    allocatable[key] = (allocatable.get(key, 0) |
+                                        _range_bitmap(first_id,
+                                                      vlan_min, vlan_max))
+
+        blocks = session.query(mlnx_models_v2.SegmentationIdBlock).all()
+        for block in blocks:
+            bitmap = allocatable.pop((block.physical_network,
+                                      block.first_id), 0)
+            if not bitmap and not _bitmap(block.allocated):
+                LOG.debug(_("Removing vlans %(first_id)s-%(last_id)s on "
+                            "physical network %(net)s from pool"),
+                          {'first_id': block.first_id,
+                           'last_id': block.first_id + BLOCK_SIZE - 1,
+                           'net': block.physical_network})
+                session.delete(block)
+                continue
+            block.allocatable = _hex(bitmap)
+            _update_free_count(block)
+
+        # add blocks of newly configured vlan ranges
+        for (physical_network, first_id), bitmap in allocatable.iteritems():
+            block = mlnx_models_v2.SegmentationIdBlock(physical_network,
+                                                       first_id)
+            block.allocatable = _hex(bitmap)
+            _update_free_count(block)
+            session.add(block)
 
-            # remove from table unallocated vlans not currently allocatable
-            _remove_non_allocatable_vlans(session, allocations,
-                                          physical_network, vlan_ids)
 
-            # add missing allocatable vlans to table
-            _add_missing_allocatable_vlans(session, physical_network, vlan_ids)
+def get_network_state(physical_network, segmentation_id):
+    """Get state of specified network.
+
+    Returns None if the segmentation_id is neither allocatable nor
+    allocated.
+    """
+    session = db.get_session()
+    block = (session.query(mlnx_models_v2.SegmentationIdBlock).
+             filter_by(physical_network=physical_network,
+                       first_id=_block_first_id(segmentation_id)).
+             first())
+    if not block:
+        return
+    bit = 1 << (segmentation_id - block.first_id)
+    allocated = bool(_bitmap(block.allocated) & bit)
+    if not allocated and not _bitmap(block.allocatable) & bit:
+        return
+    return NetworkState(physical_network, segmentation_id, allocated)
 
-        # remove from table unallocated vlans for any unconfigured physical
-        # networks
-        _remove_unconfigured_vlans(session, allocations)
 
+def _claim_segmentation_id(session, block):
+    """Claim a random free segmentation_id of a block.
 
-def get_network_state(physical_network, segmentation_id):
-    """Get entry of specified network."""
-    session = db.get_session()
-    qry = session.query(mlnx_models_v2.SegmentationIdAllocation)
-    qry = qry.filter_by(physical_network=physical_network,
-                        segmentation_id=segmentation_id)
-    return qry.first()
+    The block row is only updated if its allocated bitmap is still the one
+    read, so concurrent claims of the same block do not both succeed.
+
+    :returns: the segmentation_id, or None if the block changed
+    """
+    allocated = block.allocated
+    free = _bitmap(block.allocatable) & ~_bitmap(allocated)
+    if not free:
+        return
+    n = random.choice([n for n in xrange(BLOCK_SIZE) if free >> n & 1])
+    model = mlnx_models_v2.SegmentationIdBlock
+    count = (session.query(model).
+             filter_by(physical_network=block.physical_network,
+                       first_id=block.first_id,
+                       allocated=allocated).
+             update({'allocated': _hex(_bitmap(allocated) | 1 << n),
+                     'free_count': model.free_count - 1},
+                    synchronize_session='evaluate'))
+    if count:
+        return block.first_id + n
 
 
 def reserve_network(session):
+    """Reserve a segmentation_id from the pool.
+
+    The blocks with free segmentation_ids are tried in random order with
+    a compare-and-swap update, so concurrent reservations seldom claim the
+    same block. A block changed since it was read is skipped for the next
+    one. Only when all of them changed are they re-read with a lock, one
+    after the other, and claimed under that lock.
+    """
     with session.begin(subtransactions=True):
-        entry = (session.query(mlnx_models_v2.SegmentationIdAllocation).
-                 filter_by(allocated=False).
-                 with_lockmode('update').
-                 first())
-        if not entry:
-            raise q_exc.NoNetworkAvailable()
+        model = mlnx_models_v2.SegmentationIdBlock
+        blocks = (session.query(model.physical_network, model.first_id,
+                                model.allocatable, model.allocated).
+                  filter(model.free_count > 0).
+                  all())
+        random.shuffle(blocks)
+        for block in blocks:
+            segmentation_id = _claim_segmentation_id(session, block)
+            if segmentation_id is not None:
+                break
+        else:
+            for block in blocks:
+                LOG.debug(_("Segmentation id block %(first_id)s on physical "
+                            "network %(net)s changed, retrying with lock"),
+                          {'first_id': block.first_id,
+                           'net': block.physical_network})
+                locked = _get_block(session, block.physical_network,
+                                    block.first_id)
+                segmentation_id = (locked and
+                                   _claim_segmentation_id(session, locked))
+                if segmentation_id is not None:
+                    break
+            else:
+                raise q_exc.NoNetworkAvailable()
         LOG.debug(_("Reserving vlan %(seg_id)s on physical network "
                     "%(net)s from pool"),
-                  {'seg_id': entry.segmentation_id,
-                   'net': entry.physical_network})
-        entry.allocated = True
-        return (entry.physical_network, entry.segmentation_id)
+                  {'seg_id': segmentation_id,
+                   'net': block.physical_network})
+        return (block.physical_network, segmentation_id)
 
 
 def reserve_specific_network(session, physical_network, segmentation_id):
     with session.begin(subtransactions=True):
         log_args = {'seg_id': segmentation_id, 'phy_net': physical_network}
-        try:
-            entry = (session.query(mlnx_models_v2.SegmentationIdAllocation).
-                     filter_by(physical_network=physical_network,
-                     segmentation_id=segmentation_id).
-                     with_lockmode('update').
-                     one())
-            if entry.allocated:
-                raise q_exc.VlanIdInUse(vlan_id=segmentation_id,
-                                        physical_network=physical_network)
+        block = _get_block(session, physical_network, segmentation_id)
+        if not block:
+            block = mlnx_models_v2.SegmentationIdBlock(
+                physical_network, _block_first_id(segmentation_id))
+            session.add(block)
+        bit = 1 << (segmentation_id - block.first_id)
+        allocated = _bitmap(block.allocated)
+        if allocated & bit:
+            raise q_exc.VlanIdInUse(vlan_id=segmentation_id,
+                                    physical_network=physical_network)
+        if _bitmap(block.allocatable) & bit:
             LOG.debug(_("Reserving specific vlan %(seg_id)s "
                         "on physical network %(phy_net)s from pool"),
                       log_args)
-            entry.allocated = True
-        except exc.NoResultFound:
+            block.free_count -= 1
+        else:
             LOG.debug(_("Reserving specific vlan %(seg_id)s on "
                         "physical network %(phy_net)s outside pool"),
                       log_args)
-            entry = mlnx_models_v2.SegmentationIdAllocation(physical_network,
-                                                            segmentation_id)
-            entry.allocated = True
-            session.add(entry)
+        block.allocated = _hex(allocated | bit)
 
 
 def release_network(session, physical_network,
                     segmentation_id, network_vlan_ranges):
+    """Release a segmentation_id.
+
+    Whether it returns to the pool is decided by the allocatable bitmaps,
+    which sync_network_states builds from network_vlan_ranges.
+    """
     with session.begin(subtransactions=True):
         log_args = {'seg_id': segmentation_id, 'phy_net': physical_network}
-        try:
-            state = (session.query(mlnx_models_v2.SegmentationIdAllocation).
-                     filter_by(physical_network=physical_network,
-                               segmentation_id=segmentation_id).
-                     with_lockmode('update').
-                     one())
-            state.allocated = False
-            inside = False
-            for vlan_range in network_vlan_ranges.get(physical_network, []):
-                if (segmentation_id >= vlan_range[0] and
-                    segmentation_id <= vlan_range[1]):
-                    inside = True
-                    break
-            if inside:
-                LOG.debug(_("Releasing vlan %(seg_id)s "
-                            "on physical network "
-                            "%(phy_net)s to pool"),
-                          log_args)
-            else:
-                LOG.debug(_("Releasing vlan %(seg_id)s "
-                            "on physical network "
-                            "%(phy_net)s outside pool"),
-                          log_args)
-                session.delete(state)
-        except exc.NoResultFound:
+        block = _get_block(session, physical_network, segmentation_id)
+        bit = 1 << (segmentation_id - _block_first_id(segmentation_id))
+        if not block or not _bitmap(block.allocated) & bit:
             LOG.warning(_("vlan_id %(seg_id)s on physical network "
                           "%(phy_net)s not found"),
                         log_args)
+            return
+        block.allocated = _hex(_bitmap(block.allocated) & ~bit)
+        if _bitmap(block.allocatable) & bit:
+            LOG.debug(_("Releasing vlan %(seg_id)s "
+                        "on physical network "
+                        "%(phy_net)s to pool"),
+                      log_args)
+            block.free_count += 1
+        else:
+            LOG.debug(_("Releasing vlan %(seg_id)s "
+                        "on physical network "
+                        "%(phy_net)s outside pool"),
+                      log_args)
+            if not (_bitmap(block.allocatable) or
+                    _bitmap(block.allocated)):
+                session.delete(block)
 
 
 def add_network_binding(session, network_id, network_type,
@@ -195,11 +350,43 @@ def add_network_binding(session, network_id, network_type,
         binding = mlnx_models_v2.NetworkBinding(network_id, network_type,
                                                 physical_network, vlan_id)
         session.add(binding)
+    return binding
 
 
 def get_network_binding(session, network_id):
-    return (session.query(mlnx_models_v2.NetworkBinding).
-            filter_by(network_id=network_id).first())
+    """Get network binding, from network_binding_cache when possible."""
+    binding = network_binding_cache.get(network_id)
+    if binding:
+        return binding
+    binding = (session.query(mlnx_models_v2.NetworkBinding).
+               filter_by(network_id=network_id).first())
+    if binding:
+        return network_binding_cache.add(binding) or binding
+
+
+def get_network_bindings(session, network_ids):
+    """Get network bindings of several networks in a single query.
+
+    Bindings found in network_binding_cache are not queried.
+
+    :returns: dict of bindings keyed by network_id
+    """
+    bindings = {}
+    missing = []
+    for network_id in network_ids:
+        binding = network_binding_cache.get(network_id)
+        if binding:
+            bindings[network_id] = binding
+        else:
+            missing.append(network_id)
+    if not missing:
+        return bindings
+    binding_net_id = mlnx_models_v2.NetworkBinding.network_id
+    for binding in (session.query(mlnx_models_v2.NetworkBinding).
+                    filter(binding_net_id.in_(missing)).all()):
+        bindings[binding.network_id] = (network_binding_cache.add(binding) or
+                                        binding)
+    return bindings
 
 
 def add_port_profile_binding(session, port_id, vnic_type):
@@ -217,8 +404,25 @@ def get_port_profile_binding(session, port_id):
         return
 
 
+def get_port_profile_bindings(session, port_ids):
+    """Get port profile bindings of several ports in a single query.
+
+    :returns: dict of bindings keyed by port_id
+    """
+    if not port_ids:
+        return {}
+    binding_port_id = mlnx_models_v2.PortProfileBinding.port_id
+    bindings = (session.query(mlnx_models_v2.PortProfileBinding).
+                filter(binding_port_id.in_(port_ids)).all())
+    return dict((binding.port_id, binding) for binding in bindings)
+
+
 def get_port_from_device(device):
-    """Get port from database."""
+    """Get port from database by port id or port id prefix.
+
+    A complete port id is matched with an equality on the primary key,
+    only shorter prefixes need a LIKE.
+    """
     LOG.debug(_("get_port_from_device() called"))
     session = db.get_session()
     sg_binding_port = sg_db.SecurityGroupPortBinding.port_id
@@ -227,7 +431,10 @@ def get_port_from_device(device):
                           sg_db.SecurityGroupPortBinding.security_group_id)
     query = query.outerjoin(sg_db.SecurityGroupPortBinding,
                             models_v2.Port.id == sg_binding_port)
-    query = query.filter(models_v2.Port.id.startswith(device))
+    if len(device) == PORT_ID_LENGTH:
+        query = query.filter(models_v2.Port.id == device)
+    else:
+        query = query.filter(models_v2.Port.id.startswith(device))
     port_and_sgs = query.all()
     if not port_and_sgs:
         return
@@ -253,6 +460,33 @@ def get_port_from_device_mac(device_mac):
     return qry.first()
 
 
+def get_ports_and_bindings_by_id_or_mac(devices):
+    """Get ports whose id or MAC is in devices, with network bindings."""
+    LOG.debug(_("get_ports_and_bindings_by_id_or_mac() called"))
+    if not devices:
+        return []
+    session = db.get_session()
+    binding_net_id = mlnx_models_v2.NetworkBinding.network_id
+    query = session.query(models_v2.Port, mlnx_models_v2.NetworkBinding)
+    query = query.outerjoin(mlnx_models_v2.NetworkBinding,
+                            models_v2.Port.network_id == binding_net_id)
+    query = query.filter(sa.or_(models_v2.Port.id.in_(devices),
+                                models_v2.Port.mac_address.in_(devices)))
+    return query.all()
+
+
+def get_ports_by_id_or_mac(devices):
+    """Get ports from database whose id or MAC is in devices."""
+    LOG.debug(_("get_ports_by_id_or_mac() called"))
+    if not devices:
+        return []
+    session = db.get_session()
+    query = session.query(models_v2.Port)
+    query = query.filter(sa.or_(models_v2.Port.id.in_(devices),
+                                models_v2.Port.mac_address.in_(devices)))
+    return query.all()
+
+
 def set_port_status(port_id, status):
     """Set the port status."""
     LOG.debug(_("Set_port_status as %s called"), status)
@@ -264,3 +498,15 @@ def set_port_status(port_id, status):
         session.flush()
     except exc.NoResultFound:
         raise q_exc.PortNotFound(port_id=port_id)
+
+
+def set_ports_status(port_ids, status):
+    """Set the status of several ports with a single update."""
+    LOG.debug(_("Set_ports_status as %s called"), status)
+    if not port_ids:
+        return
+    session = db.get_session()
+    with session.begin(subtransactions=True):
+        (session.query(models_v2.Port).
+         filter(models_v2.Port.id.in_(port_ids)).
+         update({'status': status}, synchronize_session=False))
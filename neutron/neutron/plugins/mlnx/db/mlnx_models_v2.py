@@ -20,25 +20,40 @@ import sqlalchemy as sa
 from neutron.db import model_base
 
 
-class SegmentationIdAllocation(model_base.BASEV2):
-    """Represents allocation state of segmentation_id on physical network."""
-    __tablename__ = 'segmentation_id_allocation'
+# number of segmentation_ids covered by a SegmentationIdBlock
+SEGMENTATION_ID_BLOCK_SIZE = 256
+
+
+class SegmentationIdBlock(model_base.BASEV2):
+    """Represents allocation state of a block of segmentation_ids.
+
+    Bit n of the bitmaps stands for segmentation_id first_id + n on the
+    physical network. The bitmaps are stored as hex strings.
+    """
+    __tablename__ = 'segmentation_id_blocks'
 
     physical_network = sa.Column(sa.String(64), nullable=False,
                                  primary_key=True)
-    segmentation_id = sa.Column(sa.Integer, nullable=False, primary_key=True,
-                                autoincrement=False)
-    allocated = sa.Column(sa.Boolean, nullable=False, default=False)
-
-    def __init__(self, physical_network, segmentation_id):
+    first_id = sa.Column(sa.Integer, nullable=False, primary_key=True,
+                         autoincrement=False)
+    # segmentation_ids inside the configured ranges
+    allocatable = sa.Column(sa.String(64), nullable=False)
+    allocated = sa.Column(sa.String(64), nullable=False)
+    # number of allocatable segmentation_ids not allocated
+    free_count = sa.Column(sa.Integer, nullable=False, index=True)
+
+    def __init__(self, physical_network, first_id):
         self.physical_network = physical_network
-        self.segmentation_id = segmentation_id
-        self.allocated = False
+        self.first_id = first_id
+        self.allocatable = '0'
+        self.allocated = '0'
+        self.free_count = 0
 
     def __repr__(self):
-        return "<SegmentationIdAllocation(%s,%d,%s)>" % (self.physical_network,
-                                                         self.segmentation_id,
-                                                         self.allocated)
+        return "<SegmentationIdBlock(%s,%d,%s,%s)>" % (self.physical_network,
+                                                       self.first_id,
+                                                       self.allocatable,
+                                                       self.allocated)
 
 
 class NetworkBinding(model_base.BASEV2):
@@ -145,8 +145,9 @@ class MellanoxEswitchPlugin(db_base_plugin_v2.NeutronDbPluginV2,
         if physical_network not in self.network_vlan_ranges:
             self.network_vlan_ranges[physical_network] = []
 
-    def _extend_network_dict_provider(self, context, network):
-        binding = db.get_network_binding(context.session, network['id'])
+    def _extend_network_dict_provider(self, context, network, binding=None):
+        if not binding:
+            binding = db.get_network_binding(context.session, network['id'])
         network[provider.NETWORK_TYPE] = binding.network_type
         if binding.network_type == constants.TYPE_FLAT:
             network[provider.PHYSICAL_NETWORK] = binding.physical_network
@@ -316,16 +317,17 @@ class MellanoxEswitchPlugin(db_base_plugin_v2.NeutronDbPluginV2,
                                                 vlan_id)
             net = super(MellanoxEswitchPlugin, self).create_network(context,
                                                                     network)
-            db.add_network_binding(session, net['id'],
-                                   network_type,
-                                   physical_network,
-                                   vlan_id)
+            binding = db.add_network_binding(session, net['id'],
+                                             network_type,
+                                             physical_network,
+                                             vlan_id)
 
             self._process_l3_create(context, net, network['network'])
-            self._extend_network_dict_provider(context, net)
+            self._extend_network_dict_provider(context, net, binding)
             # note - exception will rollback entire transaction
             LOG.debug(_("Created network: %s"), net['id'])
-            return net
+        db.network_binding_cache.add(binding)
+        return net
 
     def update_network(self, context, net_id, network):
         LOG.debug(_("update network"))
@@ -353,6 +355,7 @@ class MellanoxEswitchPlugin(db_base_plugin_v2.NeutronDbPluginV2,
                                    self.network_vlan_ranges)
             # the network_binding record is deleted via cascade from
             # the network record, so explicit removal is not necessary
+        db.network_binding_cache.invalidate(net_id)
         self.notifier.network_delete(context, net_id)
 
     def get_network(self, context, net_id, fields=None):
@@ -371,22 +374,41 @@ class MellanoxEswitchPlugin(db_base_plugin_v2.NeutronDbPluginV2,
             nets = super(MellanoxEswitchPlugin,
                          self).get_networks(context, filters, None, sorts,
                                             limit, marker, page_reverse)
+            # load the provider bindings of all networks in one query
+            bindings = db.get_network_bindings(session,
+                                               [net['id'] for net in nets])
             for net in nets:
-                self._extend_network_dict_provider(context, net)
+                self._extend_network_dict_provider(context, net,
+                                                   bindings.get(net['id']))
 
         return [self._fields(net, fields) for net in nets]
 
-    def _extend_port_dict_binding(self, context, port):
-        port_binding = db.get_port_profile_binding(context.session,
-                                                   port['id'])
+    def _set_port_dict_binding(self, port, port_binding, binding):
         if port_binding:
             port[portbindings.VIF_TYPE] = port_binding.vnic_type
-        binding = db.get_network_binding(context.session,
-                                         port['network_id'])
         fabric = binding.physical_network
         port[portbindings.PROFILE] = {'physical_network': fabric}
         return port
 
+    def _extend_port_dict_binding(self, context, port):
+        port_binding = db.get_port_profile_binding(context.session,
+                                                   port['id'])
+        binding = db.get_network_binding(context.session,
+                                         port['network_id'])
+        return self._set_port_dict_binding(port, port_binding, binding)
+
+    def _extend_ports_dict_binding(self, context, ports):
+        """Extend several ports with two queries in total."""
+        port_bindings = db.get_port_profile_bindings(
+            context.session, [port['id'] for port in ports])
+        bindings = db.get_network_bindings(
+            context.session, list(set(port['network_id'] for port in ports)))
+        for port in ports:
+            self._set_port_dict_binding(port,
+                                        port_bindings.get(port['id']),
+                                        bindings[port['network_id']])
+        return ports
+
     def create_port(self, context, port):
         LOG.debug(_("create_port with %s"), port)
         session = context.session
@@ -422,14 +444,11 @@ class MellanoxEswitchPlugin(db_base_plugin_v2.NeutronDbPluginV2,
 
     def get_ports(self, context, filters=None, fields=None,
                   sorts=None, limit=None, marker=None, page_reverse=False):
-        res_ports = []
         ports = super(MellanoxEswitchPlugin,
                       self).get_ports(context, filters, fields, sorts,
                                       limit, marker, page_reverse)
-        for port in ports:
-            port = self._extend_port_dict_binding(context, port)
-            res_ports.append(self._fields(port, fields))
-        return res_ports
+        ports = self._extend_ports_dict_binding(context, ports)
+        return [self._fields(port, fields) for port in ports]
 
     def update_port(self, context, port_id, port):
         original_port = self.get_port(context, port_id)
@@ -14,6 +14,8 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import re
+
 from oslo.config import cfg
 
 from neutron.common import constants as q_const
@@ -28,15 +30,20 @@ from neutron.plugins.mlnx.db import mlnx_db_v2 as db
 
 LOG = logging.getLogger(__name__)
 
+MAC_PATTERN = re.compile('^([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$')
+
 
 class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin,
                        l3_rpc_base.L3RpcCallbackMixin,
                        sg_db_rpc.SecurityGroupServerRpcCallbackMixin):
     # History
     #  1.1 Support Security Group RPC
-    RPC_API_VERSION = '1.1'
+    #  1.2 Support get_devices_details_list
+    #  1.3 Support update_devices_down and update_devices_up
+    RPC_API_VERSION = '1.3'
 
     #to be compatible with Linux Bridge Agent on Network Node
+    TAP_PREFIX = 'tap'
     TAP_PREFIX_LEN = 3
 
     def __init__(self):
@@ -58,17 +65,41 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin,
 
         To maintain compatibility with Linux Bridge L2 Agent for DHCP/L3
         services get device either by linux bridge plugin
-        device name convention or by mac address
+        device name convention, by port id or by mac address. The form
+        of the device decides which one, so a single query is made.
         """
-        port = db.get_port_from_device(device[cls.TAP_PREFIX_LEN:])
+        if MAC_PATTERN.match(device):
+            port = db.get_port_from_device_mac(device)
+        elif device.startswith(cls.TAP_PREFIX):
+            port = db.get_port_from_device(device[cls.TAP_PREFIX_LEN:])
+        else:
+            port = db.get_port_from_device(device)
         if port:
             port['device'] = device
-        else:
-            port = db.get_port_from_device_mac(device)
-            if port:
-                port['device'] = device
         return port
 
+    @classmethod
+    def _is_exact_device(cls, device):
+        """Whether the device is a MAC or a port id, found by bulk lookups.
+
+        Only the other forms of device need get_port_from_device.
+        """
+        return bool(MAC_PATTERN.match(device) or
+                    len(device) == db.PORT_ID_LENGTH)
+
+    def _get_device_details(self, device, port, binding):
+        entry = {'device': device,
+                 'physical_network': binding.physical_network,
+                 'network_type': binding.network_type,
+                 'segmentation_id': binding.segmentation_id,
+                 'network_id': port['network_id'],
+                 'port_mac': port['mac_address'],
+                 'port_id': port['id'],
+                 'admin_state_up': port['admin_state_up']}
+        if cfg.CONF.AGENT.rpc_support_old_agents:
+            entry['vlan_id'] = binding.segmentation_id
+        return entry
+
     def get_device_details(self, rpc_context, **kwargs):
         """Agent requests device details."""
         agent_id = kwargs.get('agent_id')
@@ -79,16 +110,7 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin,
         if port:
             binding = db.get_network_binding(db_api.get_session(),
                                              port['network_id'])
-            entry = {'device': device,
-                     'physical_network': binding.physical_network,
-                     'network_type': binding.network_type,
-                     'segmentation_id': binding.segmentation_id,
-                     'network_id': port['network_id'],
-                     'port_mac': port['mac_address'],
-                     'port_id': port['id'],
-                     'admin_state_up': port['admin_state_up']}
-            if cfg.CONF.AGENT.rpc_support_old_agents:
-                entry['vlan_id'] = binding.segmentation_id
+            entry = self._get_device_details(device, port, binding)
             new_status = (q_const.PORT_STATUS_ACTIVE if port['admin_state_up']
                           else q_const.PORT_STATUS_DOWN)
             if port['status'] != new_status:
@@ -98,13 +120,61 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin,
             LOG.debug("%s can not be found in database", device)
         return entry
 
+    def get_devices_details_list(self, rpc_context, **kwargs):
+        """Agent requests details of a list of devices.
+
+        Devices given by MAC address or port id are looked up in a single
+        query, only the other forms are looked up one by one.
+        """
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices', [])
+        LOG.debug(_("Details of %(count)d devices requested from "
+                    "%(agent_id)s"),
+                  {'count': len(devices), 'agent_id': agent_id})
+        ports = {}
+        for port, binding in db.get_ports_and_bindings_by_id_or_mac(devices):
+            ports[port['id']] = (port, binding)
+            ports[port['mac_address']] = (port, binding)
+        entries = []
+        new_statuses = {}
+        for device in devices:
+            if device in ports:
+                port, binding = ports[device]
+            elif self._is_exact_device(device):
+                port = None
+            else:
+                port = self.get_port_from_device(device)
+                binding = port and db.get_network_binding(
+                    db_api.get_session(), port['network_id'])
+            if not port:
+                entries.append({'device': device})
+                LOG.debug(_("%s can not be found in database"), device)
+                continue
+            if binding is None:
+                # reported as not found, so the other devices get their
+                # details
+                entries.append({'device': device})
+                LOG.warning(_("Network %(network_id)s of device %(device)s "
+                              "has no binding"),
+                            {'network_id': port['network_id'],
+                             'device': device})
+                continue
+            entries.append(self._get_device_details(device, port, binding))
+            new_status = (q_const.PORT_STATUS_ACTIVE if port['admin_state_up']
+                          else q_const.PORT_STATUS_DOWN)
+            if port['status'] != new_status:
+                new_statuses.setdefault(new_status, []).append(port['id'])
+        for status, port_ids in new_statuses.iteritems():
+            db.set_ports_status(port_ids, status)
+        return entries
+
     def update_device_down(self, rpc_context, **kwargs):
         """Device no longer exists on agent."""
         agent_id = kwargs.get('agent_id')
         device = kwargs.get('device')
         LOG.debug(_("Device %(device)s no longer exists on %(agent_id)s"),
                   {'device': device, 'agent_id': agent_id})
-        port = db.get_port_from_device(device)
+        port = self.get_port_from_device(device)
         if port:
             entry = {'device': device,
                      'exists': True}
@@ -130,3 +200,50 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin,
                 db.set_port_status(port['id'], q_const.PORT_STATUS_ACTIVE)
         else:
             LOG.debug(_("%s can not be found in database"), device)
+
+    def _get_ports_from_devices(self, devices):
+        """Get ports of devices given by port id or MAC address.
+
+        Ids and MACs are resolved in a single query, only the other forms
+        of device are looked up one by one.
+
+        :returns: dict of device to port for the devices found
+        """
+        ports = {}
+        for port in db.get_ports_by_id_or_mac(devices):
+            ports[port['id']] = port
+            ports[port['mac_address']] = port
+        found = {}
+        for device in devices:
+            port = ports.get(device)
+            if port is None and not self._is_exact_device(device):
+                port = self.get_port_from_device(device)
+            if port:
+                found[device] = port
+            else:
+                LOG.debug(_("%s can not be found in database"), device)
+        return found
+
+    def _set_devices_status(self, ports, status):
+        db.set_ports_status([port['id'] for port in ports
+                             if port['status'] != status], status)
+
+    def update_devices_down(self, rpc_context, **kwargs):
+        """Devices no longer exist on agent."""
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices', [])
+        LOG.debug(_("Devices %(devices)s no longer exist on %(agent_id)s"),
+                  {'devices': devices, 'agent_id': agent_id})
+        ports = self._get_ports_from_devices(devices)
+        self._set_devices_status(ports.values(), q_const.PORT_STATUS_DOWN)
+        return [{'device': device, 'exists': device in ports}
+                for device in devices]
+
+    def update_devices_up(self, rpc_context, **kwargs):
+        """Devices are up on agent."""
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices', [])
+        LOG.debug(_("Devices %(devices)s up %(agent_id)s"),
+                  {'devices': devices, 'agent_id': agent_id})
+        ports = self._get_ports_from_devices(devices)
+        self._set_devices_status(ports.values(), q_const.PORT_STATUS_ACTIVE)
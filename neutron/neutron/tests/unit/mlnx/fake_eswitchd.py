@@ -0,0 +1,240 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fake eSwitch daemon speaking the eSwitchD ZMQ JSON protocol.
+
+It keeps the attached vNICs and their eSwitch configuration in memory,
+so the agent can be run without Mellanox hardware. vNICs are attached
+and detached by the test, which reads back when each of them was
+programmed.
+"""
+
+import random
+import threading
+import time
+
+import zmq
+
+from neutron.openstack.common import jsonutils
+from neutron.plugins.mlnx.agent import utils
+
+PORT_ACTIONS = ('set_vlan', 'port_up', 'port_down', 'port_release')
+
+
+class FakeEswitchd(object):
+    """eSwitchD double served from a thread.
+
+    :param legacy: serve on a REP socket and answer like an old daemon,
+                   without msg_id in replies and without batch,
+                   get_vnics_delta and negotiate_codec support. A ROUTER
+                   socket supporting them is used otherwise.
+    :param latency: seconds each action takes
+    :param failure_rate: probability of an action in failure_actions to
+                         fail
+    :param failure_actions: actions failures are injected into
+    :param publish_events: publish vNIC attach/detach events
+    :param seed: seed of the failure injection
+    :param codecs: names of the codecs agreed on if the agent offers them
+    """
+
+    def __init__(self, legacy=False, latency=0, failure_rate=0,
+                 failure_actions=PORT_ACTIONS, publish_events=False,
+                 seed=0, codecs=('msgpack', 'json')):
+        self.legacy = legacy
+        self.codecs = [codec for codec in utils.get_codecs(codecs)
+                       if codec.name in codecs]
+        # ROUTER peer identity -> codec negotiated on the connection
+        self.peer_codecs = {}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_actions = failure_actions
+        self.publish_events = publish_events
+        self.random = random.Random(seed)
+        self.fabrics = {}
+        # mac -> {'fabric', 'vlan', 'up'} of the attached vNICs
+        self.vnics = {}
+        # generation of the last vNIC change, and mac -> generation of
+        # the last change of the vNIC since the oldest generation known
+        self.generation = 0
+        self._changes = {}
+        self._oldest = 0
+        # mac -> time the vNIC was attached/detached
+        self.attached_at = {}
+        self.detached_at = {}
+        # mac -> time the vNIC was last set up/released
+        self.up_at = {}
+        self.released_at = {}
+        self.requests = 0
+        self.endpoint = None
+        self.events_endpoint = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._context = zmq.Context()
+        self._socket = self._context.socket(
+            zmq.REP if self.legacy else zmq.ROUTER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.bind('tcp://127.0.0.1:*')
+        self.endpoint = self._socket.getsockopt(zmq.LAST_ENDPOINT)
+        self._publisher = None
+        if self.publish_events:
+            self._publisher = self._context.socket(zmq.PUB)
+            self._publisher.setsockopt(zmq.LINGER, 0)
+            self._publisher.bind('tcp://127.0.0.1:*')
+            self.events_endpoint = self._publisher.getsockopt(
+                zmq.LAST_ENDPOINT)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self._socket.close()
+        if self._publisher is not None:
+            self._publisher.close()
+        self._context.term()
+
+    def attach(self, macs, fabric='default'):
+        now = time.time()
+        with self._lock:
+            for mac in macs:
+                self.vnics[mac] = {'fabric': fabric, 'vlan': None,
+                                   'up': False}
+                self.attached_at[mac] = now
+                self._changed(mac)
+                self._publish(utils.VNIC_ATTACHED, mac)
+
+    def detach(self, macs):
+        now = time.time()
+        with self._lock:
+            for mac in macs:
+                self.vnics.pop(mac, None)
+                self.detached_at[mac] = now
+                self._changed(mac)
+                self._publish(utils.VNIC_DETACHED, mac)
+
+    def forget_changes(self):
+        """Forget the vNIC changes, as after a daemon restart."""
+        with self._lock:
+            self._changes = {}
+            self._oldest = self.generation
+
+    def _changed(self, mac):
+        self.generation += 1
+        self._changes[mac] = self.generation
+
+    def _publish(self, event, mac):
+        if self._publisher is not None:
+            self._publisher.send(jsonutils.dumps({'event': event,
+                                                  'mac': mac}))
+
+    def _serve(self):
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        while self._running:
+            if not poller.poll(100):
+                continue
+            frames = self._socket.recv_multipart()
+            codec = self.peer_codecs.get(frames[0], utils.JSON_CODEC)
+            msg = codec.decode(frames[-1])
+            if msg.get('action') == 'negotiate_codec' and not self.legacy:
+                reply = self._negotiate_codec(frames[0], msg)
+            else:
+                reply = self._handle(msg)
+            if 'msg_id' in msg and not self.legacy:
+                reply['msg_id'] = msg['msg_id']
+            self._socket.send_multipart(frames[:-1] + [codec.encode(reply)])
+
+    def _negotiate_codec(self, peer, msg):
+        for codec in self.codecs:
+            if codec.name in msg['codecs']:
+                break
+        else:
+            codec = utils.JSON_CODEC
+        # the messages after the reply are in the codec agreed on
+        self.peer_codecs[peer] = codec
+        return {'status': 'OK', 'response': codec.name}
+
+    def _handle(self, msg):
+        with self._lock:
+            self.requests += 1
+            if msg.get('action') == 'batch' and not self.legacy:
+                return {'status': 'OK',
+                        'response': [self._do(op) for op in msg['ops']]}
+            return self._do(msg)
+
+    def _vnics(self, fabric, macs):
+        return dict((mac, {'fabric': self.vnics[mac]['fabric']})
+                    for mac in macs
+                    if fabric in ('*', self.vnics[mac]['fabric']))
+
+    def _vnics_delta(self, msg):
+        since = msg['generation']
+        if since is None or not self._oldest <= since <= self.generation:
+            return {'generation': self.generation,
+                    'vnics': self._vnics(msg['fabric'], self.vnics)}
+        changed = [mac for mac, generation in self._changes.iteritems()
+                   if generation > since]
+        return {'generation': self.generation,
+                'added': self._vnics(msg['fabric'],
+                                     [mac for mac in changed
+                                      if mac in self.vnics]),
+                'removed': [mac for mac in changed
+                            if mac not in self.vnics]}
+
+    def _fail(self, msg, reason):
+        return {'status': 'FAIL', 'action': msg.get('action'),
+                'reason': reason}
+
+    def _do(self, msg):
+        if self.latency:
+            time.sleep(self.latency)
+        action = msg.get('action')
+        if (action in self.failure_actions and
+                self.random.random() < self.failure_rate):
+            return self._fail(msg, 'injected failure')
+        if action == 'get_vnics':
+            return {'status': 'OK',
+                    'response': self._vnics(msg['fabric'], self.vnics)}
+        if action == 'get_vnics_delta' and not self.legacy:
+            return {'status': 'OK', 'response': self._vnics_delta(msg)}
+        if action == 'define_fabric_mapping':
+            self.fabrics[msg['fabric']] = msg['interface']
+            return {'status': 'OK'}
+        if action not in PORT_ACTIONS:
+            return self._fail(msg, 'unknown action')
+        mac = msg.get('port_mac') or msg.get('mac')
+        if action == 'port_release':
+            if mac in self.vnics:
+                self.vnics[mac].update(vlan=None, up=False)
+            self.released_at[mac] = time.time()
+            return {'status': 'OK'}
+        vnic = self.vnics.get(mac)
+        if vnic is None:
+            return self._fail(msg, 'vNIC %s not attached' % mac)
+        if action == 'set_vlan':
+            vnic['vlan'] = msg['vlan']
+        else:
+            vnic['up'] = action == 'port_up'
+            if vnic['up']:
+                self.up_at[mac] = time.time()
+        return {'status': 'OK'}
@@ -25,12 +25,32 @@ class ConfigurationTest(base.BaseTestCase):
     def test_defaults(self):
         self.assertEqual(2,
                          cfg.CONF.AGENT.polling_interval)
+        self.assertEqual(0,
+                         cfg.CONF.AGENT.max_polling_interval)
+        self.assertEqual(30,
+                         cfg.CONF.AGENT.full_sync_interval)
+        self.assertEqual(60,
+                         cfg.CONF.AGENT.vnics_max_age)
+        self.assertEqual(8,
+                         cfg.CONF.AGENT.device_workers)
+        self.assertEqual(60,
+                         cfg.CONF.AGENT.retry_max_interval)
+        self.assertEqual(3600,
+                         cfg.CONF.AGENT.resync_interval)
+        self.assertIsNone(cfg.CONF.ESWITCH.vnic_events_endpoint)
+        self.assertEqual(3, cfg.CONF.ESWITCH.failure_threshold)
+        self.assertEqual(30, cfg.CONF.ESWITCH.reconnect_max_interval)
+        self.assertEqual(['msgpack', 'json'], cfg.CONF.ESWITCH.wire_codecs)
         self.assertEqual('sudo',
                          cfg.CONF.AGENT.root_helper)
         self.assertEqual('vlan',
                          cfg.CONF.MLNX.tenant_network_type)
         self.assertEqual(1,
                          len(cfg.CONF.MLNX.network_vlan_ranges))
+        self.assertEqual(10000,
+                         cfg.CONF.MLNX.network_binding_cache_size)
+        self.assertEqual(300,
+                         cfg.CONF.MLNX.network_binding_cache_ttl)
         self.assertEqual(0,
                          len(cfg.CONF.ESWITCH.
                              physical_interface_mappings))
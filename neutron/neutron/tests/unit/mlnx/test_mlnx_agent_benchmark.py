@@ -0,0 +1,183 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the eSwitch agent against a fake eSwitch daemon.
+
+Thousands of vNICs are attached then detached at once, and the agent
+loop is run until it has bound or released all of them. The number of
+ports handled per second and the p50/p99 latency from the attach or
+detach of a vNIC to its eSwitch update are logged, as well as the
+duration of a poll while no vNIC changes. Only run when
+MLNX_RUN_BENCHMARKS is set. Set MLNX_AGENT_BENCHMARK_VNICS to change the
+number of vNICs.
+"""
+
+import os
+import time
+
+import mock
+from oslo.config import cfg
+
+from neutron.openstack.common import log as logging
+from neutron.plugins.mlnx.agent import eswitch_neutron_agent
+from neutron.plugins.mlnx.agent import utils
+from neutron.tests import base
+from neutron.tests.unit.mlnx import fake_eswitchd
+
+LOG = logging.getLogger(__name__)
+
+VNICS = int(os.environ.get('MLNX_AGENT_BENCHMARK_VNICS', 2000))
+MAX_ITERATIONS = 20
+IDLE_POLLS = 100
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+class AgentStormBenchmark(base.BaseTestCase):
+
+    def setUp(self):
+        super(AgentStormBenchmark, self).setUp()
+        if not os.environ.get('MLNX_RUN_BENCHMARKS'):
+            self.skipTest("MLNX_RUN_BENCHMARKS is not set")
+        cfg.CONF.set_override('rpc_backend',
+                              'neutron.openstack.common.rpc.impl_fake')
+        cfg.CONF.set_default('firewall_driver',
+                             'neutron.agent.firewall.NoopFirewallDriver',
+                             group='SECURITYGROUP')
+        cfg.CONF.set_override('state_file', '', 'AGENT')
+        # pipelined requests to a legacy daemon are answered one by one
+        cfg.CONF.set_override('request_timeout', 60000, 'ESWITCH')
+        self.addCleanup(cfg.CONF.reset)
+        mock.patch('neutron.openstack.common.loopingcall.'
+                   'LoopingCall').start()
+        self.addCleanup(mock.patch.stopall)
+        self.macs = ['fa:16:3e:%02x:%02x:%02x' % (i >> 16, (i >> 8) & 0xff,
+                                                   i & 0xff)
+                     for i in xrange(VNICS)]
+
+    def _start(self, **kwargs):
+        self.daemon = fake_eswitchd.FakeEswitchd(**kwargs)
+        self.daemon.start()
+        self.addCleanup(self.daemon.stop)
+        cfg.CONF.set_override('daemon_endpoint', self.daemon.endpoint,
+                              'ESWITCH')
+        self.agent = eswitch_neutron_agent.MlnxEswitchNeutronAgent(
+            {'default': 'eth2'})
+        self.agent.context = mock.Mock()
+        self.agent.agent_id = 'benchmark'
+        self.agent.plugin_rpc = mock.Mock()
+        self.agent.plugin_rpc.get_devices_details_list.side_effect = (
+            self._get_devices_details_list)
+        self.agent.plugin_rpc.update_devices_down.side_effect = (
+            lambda context, devices, agent_id: [
+                {'device': device, 'exists': True} for device in devices])
+
+    def _get_devices_details_list(self, context, devices, agent_id):
+        return [{'device': mac,
+                 'port_id': 'port-%s' % mac,
+                 'port_mac': mac,
+                 'network_id': 'net1',
+                 'network_type': 'vlan',
+                 'physical_network': 'default',
+                 'segmentation_id': 5,
+                 'vlan_id': 5,
+                 'admin_state_up': True} for mac in devices]
+
+    def _run_agent(self, ports):
+        """Run the agent loop until the devices settle.
+
+        Failed devices are retried at once, without the loop's backoff.
+        """
+        for i in xrange(MAX_ITERATIONS):
+            port_info = self.agent.update_ports(ports)
+            if not port_info:
+                return ports
+            failed = self.agent.process_network_ports(port_info)
+            ports = ((port_info['current'] - failed) |
+                     (failed - port_info['current']))
+        self.fail(_("Devices did not settle in %d iterations") %
+                  MAX_ITERATIONS)
+
+    def _report(self, name, started, done):
+        elapsed = max(done.values()) - min(started.values())
+        latencies = [done[mac] - started[mac] for mac in self.macs]
+        LOG.info(_("%(name)s of %(count)d vNICs in %(elapsed).2fs "
+                   "(%(rate).1f ports per second), latency p50 "
+                   "%(p50).3fs p99 %(p99).3fs"),
+                 {'name': name, 'count': len(self.macs),
+                  'elapsed': elapsed, 'rate': len(self.macs) / elapsed,
+                  'p50': percentile(latencies, 50),
+                  'p99': percentile(latencies, 99)})
+
+    def _idle_polls(self, ports):
+        start = time.time()
+        for i in xrange(IDLE_POLLS):
+            self.assertIsNone(self.agent.update_ports(ports))
+        LOG.info(_("Poll of %(count)d unchanged vNICs in %(elapsed).2fms"),
+                 {'count': len(ports),
+                  'elapsed': (time.time() - start) * 1000 / IDLE_POLLS})
+
+    def _storm(self):
+        self.daemon.attach(self.macs)
+        ports = self._run_agent(set())
+        self.assertEqual(set(self.macs), ports)
+        self._idle_polls(ports)
+        for mac in self.macs:
+            self.assertEqual({'fabric': 'default', 'vlan': 5, 'up': True},
+                             self.daemon.vnics[mac])
+        self._report(_("Attach"), self.daemon.attached_at,
+                     self.daemon.up_at)
+
+        self.daemon.detach(self.macs)
+        self.assertEqual(set(), self._run_agent(ports))
+        self.assertEqual(set(self.macs), set(self.daemon.released_at))
+        self.assertEqual({}, self.agent.eswitch.port_map)
+        self._report(_("Detach"), self.daemon.detached_at,
+                     self.daemon.released_at)
+
+    def test_storm(self):
+        self._start()
+        self._storm()
+        if utils.msgpack is not None:
+            self.assertEqual('msgpack', self.agent.eswitch.utils.codec.name)
+
+    def test_storm_json_codec(self):
+        cfg.CONF.set_override('wire_codecs', ['json'], 'ESWITCH')
+        self._start()
+        self._storm()
+        self.assertEqual('json', self.agent.eswitch.utils.codec.name)
+
+    def test_storm_legacy_daemon(self):
+        self._start(legacy=True)
+        self._storm()
+        self.assertFalse(self.agent.eswitch.utils.batch_supported)
+
+    def test_storm_with_failures(self):
+        self._start(failure_rate=0.05, latency=0.0001)
+        self._storm()
+
+    def test_vnics_changes_forgotten_by_daemon(self):
+        self._start()
+        self.daemon.attach(self.macs)
+        ports = self._run_agent(set())
+        self.daemon.forget_changes()
+        self.daemon.detach(self.macs[:10])
+        self.assertEqual(set(self.macs[10:]), self._run_agent(ports))
@@ -0,0 +1,100 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmark of the eSwitchD wire codecs.
+
+Encodes and decodes get_vnics replies and batch requests of growing
+host densities with each codec, and logs the time taken and the size
+of the encoded message. Only run when MLNX_RUN_BENCHMARKS is set.
+"""
+
+import os
+import time
+
+from neutron.openstack.common import log as logging
+from neutron.plugins.mlnx.agent import utils
+from neutron.tests import base
+
+LOG = logging.getLogger(__name__)
+
+VNICS = (64, 512, 4096)
+ROUNDS = 20
+
+
+def vnics_reply(count):
+    vnics = {}
+    for i in xrange(count):
+        mac = 'fa:16:3e:%02x:%02x:%02x' % (i >> 16, (i >> 8) & 0xff,
+                                            i & 0xff)
+        vnics[mac] = {'fabric': 'default',
+                      'device': 'eth%d' % (i % 64),
+                      'vf': i % 64,
+                      'vlan': i % 4094 + 1}
+    return {'status': 'OK', 'msg_id': 1, 'response': vnics}
+
+
+def batch_request(count):
+    ops = []
+    for mac in vnics_reply(count)['response']:
+        ops.append(utils.set_vlan_msg('default', 5, mac))
+        ops.append(utils.port_up_msg('default', mac))
+    return {'action': 'batch', 'ops': ops, 'msg_id': 1}
+
+
+class CodecBenchmark(base.BaseTestCase):
+
+    def setUp(self):
+        super(CodecBenchmark, self).setUp()
+        if not os.environ.get('MLNX_RUN_BENCHMARKS'):
+            self.skipTest("MLNX_RUN_BENCHMARKS is not set")
+
+    def _measure(self, codec, name, msg):
+        start = time.time()
+        for i in xrange(ROUNDS):
+            data = codec.encode(msg)
+        encoded = time.time()
+        for i in xrange(ROUNDS):
+            decoded = codec.decode(data)
+        decode_time = (time.time() - encoded) / ROUNDS
+        encode_time = (encoded - start) / ROUNDS
+        self.assertEqual(msg, decoded)
+        LOG.info(_("%(codec)s %(name)s: %(bytes)d bytes, encode "
+                   "%(encode).3fms, decode %(decode).3fms"),
+                 {'codec': codec.name, 'name': name, 'bytes': len(data),
+                  'encode': encode_time * 1000,
+                  'decode': decode_time * 1000})
+
+    def _benchmark(self, codec):
+        for count in VNICS:
+            self._measure(codec, 'get_vnics of %d vNICs' % count,
+                          vnics_reply(count))
+            self._measure(codec, 'batch for %d vNICs' % count,
+                          batch_request(count))
+
+    def test_json(self):
+        self._benchmark(utils.JSON_CODEC)
+
+    def test_msgpack(self):
+        if utils.msgpack is None:
+            self.skipTest("msgpack is not installed")
+        codec = utils.CODECS['msgpack']
+        self._benchmark(codec)
+        for count in VNICS:
+            for msg in (vnics_reply(count), batch_request(count)):
+                self.assertTrue(len(codec.encode(msg)) <
+                                len(utils.JSON_CODEC.encode(msg)))
@@ -13,11 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import mock
 from testtools import matchers
 
 from neutron.common import exceptions as q_exc
 from neutron.db import api as db
 from neutron.plugins.mlnx.db import mlnx_db_v2 as mlnx_db
+from neutron.plugins.mlnx.db import mlnx_models_v2
 from neutron.tests import base
 from neutron.tests.unit import test_db_plugin as test_plugin
 
@@ -120,6 +122,29 @@ class SegmentationIdAllocationTest(base.BaseTestCase):
             mlnx_db.release_network(self.session, PHYS_NET,
                                     vlan_id, VLAN_RANGES)
 
+    def test_segmentationId_pool_skips_changed_block(self):
+        block_size = mlnx_models_v2.SEGMENTATION_ID_BLOCK_SIZE
+        mlnx_db.sync_network_states({PHYS_NET: [(1, 2 * block_size - 1)]})
+        real_claim = mlnx_db._claim_segmentation_id
+        claimed_blocks = []
+
+        def claim(session, block):
+            claimed_blocks.append(block.first_id)
+            # the first block tried was changed by another server
+            if len(claimed_blocks) > 1:
+                return real_claim(session, block)
+
+        with mock.patch.object(mlnx_db, '_claim_segmentation_id',
+                               side_effect=claim):
+            with mock.patch.object(mlnx_db, '_get_block') as get_block:
+                physical_network, vlan_id = mlnx_db.reserve_network(
+                    self.session)
+        self.assertEqual(PHYS_NET, physical_network)
+        self.assertFalse(get_block.called)
+        self.assertEqual(2, len(set(claimed_blocks)))
+        self.assertTrue(mlnx_db.get_network_state(PHYS_NET,
+                                                  vlan_id).allocated)
+
     def test_specific_segmentationId_inside_pool(self):
         vlan_id = VLAN_MIN + 5
         self.assertFalse(mlnx_db.get_network_state(PHYS_NET,
@@ -154,6 +179,77 @@ class SegmentationIdAllocationTest(base.BaseTestCase):
         mlnx_db.release_network(self.session, PHYS_NET, vlan_id, VLAN_RANGES)
         self.assertIsNone(mlnx_db.get_network_state(PHYS_NET, vlan_id))
 
+    def test_sync_keeps_allocated_outside_pool(self):
+        vlan_id = VLAN_MIN + 1
+        mlnx_db.reserve_specific_network(self.session, PHYS_NET, vlan_id)
+        mlnx_db.sync_network_states(UPDATED_VLAN_RANGES)
+        self.assertTrue(mlnx_db.get_network_state(PHYS_NET,
+                                                  vlan_id).allocated)
+        mlnx_db.release_network(self.session, PHYS_NET, vlan_id,
+                                UPDATED_VLAN_RANGES)
+        self.assertIsNone(mlnx_db.get_network_state(PHYS_NET, vlan_id))
+
+    def test_sync_large_range_uses_blocks(self):
+        mlnx_db.sync_network_states({PHYS_NET: [(1, 0x7fff)]})
+        blocks = self.session.query(mlnx_models_v2.SegmentationIdBlock).all()
+        self.assertEqual(0x8000 / mlnx_models_v2.SEGMENTATION_ID_BLOCK_SIZE,
+                         len(blocks))
+        self.assertFalse(mlnx_db.get_network_state(PHYS_NET,
+                                                   0x7fff).allocated)
+        self.assertIsNone(mlnx_db.get_network_state(PHYS_NET, 0))
+
+
+class NetworkBindingCacheTest(base.BaseTestCase):
+    def setUp(self):
+        super(NetworkBindingCacheTest, self).setUp()
+        self.cache = mlnx_db.NetworkBindingCache(size=2, ttl=10)
+
+    def _binding(self, network_id):
+        return mlnx_models_v2.NetworkBinding(network_id, NET_TYPE,
+                                             PHYS_NET, 1234)
+
+    def test_get_counts_hits_and_misses(self):
+        self.assertIsNone(self.cache.get('net1'))
+        self.cache.add(self._binding('net1'))
+        binding = self.cache.get('net1')
+        self.assertEqual(('net1', NET_TYPE, PHYS_NET, 1234), binding)
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1},
+                         self.cache.stats())
+
+    def test_stats_logged_periodically(self):
+        with mock.patch.object(mlnx_db, 'LOG') as log:
+            for now in (100, 101, 100 + mlnx_db.CACHE_STATS_LOG_INTERVAL):
+                with mock.patch('time.time', return_value=now):
+                    self.cache.get('net1')
+        self.assertEqual(2, log.debug.call_count)
+        self.assertEqual({'size': 0, 'hits': 0, 'misses': 2},
+                         log.debug.call_args[0][1])
+
+    def test_least_recently_used_evicted(self):
+        self.cache.add(self._binding('net1'))
+        self.cache.add(self._binding('net2'))
+        self.cache.get('net1')
+        self.cache.add(self._binding('net3'))
+        self.assertIsNone(self.cache.get('net2'))
+        self.assertIsNotNone(self.cache.get('net1'))
+        self.assertIsNotNone(self.cache.get('net3'))
+
+    def test_entries_expire(self):
+        with mock.patch('time.time', return_value=100):
+            self.cache.add(self._binding('net1'))
+        with mock.patch('time.time', return_value=111):
+            self.assertIsNone(self.cache.get('net1'))
+
+    def test_invalidate(self):
+        self.cache.add(self._binding('net1'))
+        self.cache.invalidate('net1')
+        self.assertIsNone(self.cache.get('net1'))
+
+    def test_disabled(self):
+        self.cache.configure(0, 10)
+        self.cache.add(self._binding('net1'))
+        self.assertIsNone(self.cache.get('net1'))
+
 
 class NetworkBindingsTest(test_plugin.NeutronDbPluginV2TestCase):
     def setUp(self):
@@ -178,3 +274,73 @@ class NetworkBindingsTest(test_plugin.NeutronDbPluginV2TestCase):
             self.assertEqual(binding.network_type, NET_TYPE)
             self.assertEqual(binding.physical_network, PHYS_NET)
             self.assertEqual(binding.segmentation_id, 1234)
+
+    def test_get_network_binding_cached(self):
+        with self.network() as network:
+            network_id = network['network']['id']
+            mlnx_db.add_network_binding(self.session, network_id,
+                                        NET_TYPE, PHYS_NET, 1234)
+            mlnx_db.get_network_binding(self.session, network_id)
+            with mock.patch.object(self.session, 'query') as query:
+                binding = mlnx_db.get_network_binding(self.session,
+                                                      network_id)
+                bindings = mlnx_db.get_network_bindings(self.session,
+                                                        [network_id])
+                self.assertFalse(query.called)
+            self.assertEqual(1234, binding.segmentation_id)
+            self.assertEqual(binding, bindings[network_id])
+
+    def test_get_network_bindings(self):
+        with self.network() as net1:
+            with self.network() as net2:
+                net1_id = net1['network']['id']
+                net2_id = net2['network']['id']
+                mlnx_db.add_network_binding(self.session, net1_id,
+                                            NET_TYPE, PHYS_NET, 1234)
+                bindings = mlnx_db.get_network_bindings(
+                    self.session, [net1_id, net2_id])
+                self.assertEqual([net1_id], bindings.keys())
+                self.assertEqual(1234, bindings[net1_id].segmentation_id)
+                self.assertEqual({}, mlnx_db.get_network_bindings(
+                    self.session, []))
+
+
+class PortsFromDevicesTest(test_plugin.NeutronDbPluginV2TestCase):
+    def setUp(self):
+        super(PortsFromDevicesTest, self).setUp()
+        mlnx_db.initialize()
+        self.session = db.get_session()
+
+    def test_get_ports_and_bindings_by_id_or_mac(self):
+        with self.port() as port1:
+            with self.port() as port2:
+                port1 = port1['port']
+                port2 = port2['port']
+                mlnx_db.add_network_binding(self.session,
+                                            port1['network_id'],
+                                            NET_TYPE, PHYS_NET, 1234)
+                res = mlnx_db.get_ports_and_bindings_by_id_or_mac(
+                    [port1['mac_address'], port2['id'], 'unknown_mac'])
+                ports = dict((port['id'], binding) for port, binding in res)
+                self.assertEqual(2, len(ports))
+                self.assertEqual(1234, ports[port1['id']].segmentation_id)
+                self.assertIsNone(ports[port2['id']])
+
+    def test_set_ports_status(self):
+        with self.port() as port1:
+            with self.port() as port2:
+                port_ids = [port1['port']['id'], port2['port']['id']]
+                mlnx_db.set_ports_status(port_ids, 'ACTIVE')
+                for port_id in port_ids:
+                    port = self._show('ports', port_id)
+                    self.assertEqual('ACTIVE', port['port']['status'])
+
+    def test_get_ports_by_id_or_mac(self):
+        with self.port() as port1:
+            with self.port() as port2:
+                port1 = port1['port']
+                port2 = port2['port']
+                ports = mlnx_db.get_ports_by_id_or_mac(
+                    [port1['id'], port2['mac_address'], 'unknown'])
+                self.assertEqual(set([port1['id'], port2['id']]),
+                                 set(port['id'] for port in ports))
@@ -0,0 +1,288 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+import mock
+import zmq
+
+from neutron.openstack.common import jsonutils
+from neutron.plugins.mlnx.agent import utils
+from neutron.plugins.mlnx.common import exceptions
+from neutron.tests import base
+
+
+class TestEswitchUtils(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestEswitchUtils, self).setUp()
+        context = mock.patch.object(utils.green_zmq, 'Context').start()
+        self.addCleanup(mock.patch.stopall)
+        self.context = context.instance.return_value
+        self.socket = self.context.socket.return_value
+        self.daemon_down = False
+        self.waits = 0
+        self.replies = []
+        self.answered = 0
+        self.socket.recv_multipart.side_effect = self._recv
+        self.utils = utils.EswitchUtils('tcp://127.0.0.1:5001', 100,
+                                        codecs=['json'])
+
+    def _recv(self, flags=0):
+        if not flags & zmq.NOBLOCK:
+            self.waits += 1
+        # the daemon only answers requests which were already sent, a
+        # blocking receive yields until it does or the request times out
+        while (self.daemon_down or not self.replies or
+               self.answered >= self.socket.send_multipart.call_count):
+            if flags & zmq.NOBLOCK:
+                raise zmq.Again()
+            eventlet.sleep(0.01)
+        self.answered += 1
+        codec = self.utils.codec or utils.JSON_CODEC
+        return ['', codec.encode(self.replies.pop(0))]
+
+    def _sent_msgs(self):
+        return [jsonutils.loads(c[0][0][-1])
+                for c in self.socket.send_multipart.call_args_list]
+
+    def test_send_msg_tags_requests(self):
+        self.replies = [{'status': 'OK', 'msg_id': 1,
+                         'response': {'00:00:00:00:00:01': 'dev'}}]
+        vnics = self.utils.get_attached_vnics()
+        self.assertEqual({'00:00:00:00:00:01': 'dev'}, vnics)
+        self.assertEqual([{'action': 'get_vnics', 'fabric': '*',
+                           'msg_id': 1}], self._sent_msgs())
+
+    def test_get_vnics_delta(self):
+        delta = {'generation': 8, 'added': {'mac2': 'dev2'},
+                 'removed': ['mac1']}
+        self.replies = [{'status': 'OK', 'msg_id': 1, 'response': delta}]
+        self.assertEqual(delta, self.utils.get_vnics_delta(7))
+        self.assertEqual([{'action': 'get_vnics_delta', 'fabric': '*',
+                           'generation': 7, 'msg_id': 1}], self._sent_msgs())
+
+    def test_get_vnics_delta_falls_back_when_unsupported(self):
+        self.replies = [{'status': 'FAIL', 'msg_id': 1,
+                         'action': 'get_vnics_delta',
+                         'reason': 'unknown action'},
+                        {'status': 'OK', 'msg_id': 2,
+                         'response': {'mac1': 'dev1'}},
+                        {'status': 'OK', 'msg_id': 3,
+                         'response': {'mac1': 'dev1'}}]
+        for i in range(2):
+            self.assertEqual({'generation': None, 'vnics': {'mac1': 'dev1'}},
+                             self.utils.get_vnics_delta(None))
+        self.assertFalse(self.utils.vnics_delta_supported)
+        self.assertEqual(['get_vnics_delta', 'get_vnics', 'get_vnics'],
+                         [m['action'] for m in self._sent_msgs()])
+
+    def test_get_vnics_delta_unsupported_not_logged_as_error(self):
+        self.replies = [{'status': 'FAIL', 'msg_id': 1,
+                         'action': 'get_vnics_delta',
+                         'reason': 'unknown action'},
+                        {'status': 'OK', 'msg_id': 2, 'response': {}}]
+        with mock.patch.object(utils, 'LOG') as log:
+            self.utils.get_vnics_delta(None)
+        self.assertFalse(log.error.called)
+
+    def test_get_vnics_delta_failure_raises(self):
+        self.replies = [{'status': 'FAIL', 'msg_id': 1,
+                         'action': 'get_vnics_delta',
+                         'reason': 'injected failure'}]
+        self.assertRaises(exceptions.MlnxActionFailed,
+                          self.utils.get_vnics_delta, None)
+        self.assertTrue(self.utils.vnics_delta_supported)
+
+    def test_codec_negotiated(self):
+        if utils.msgpack is None:
+            self.skipTest("msgpack is not installed")
+        self.utils = utils.EswitchUtils('tcp://127.0.0.1:5001', 100)
+        self.replies = [{'status': 'OK', 'msg_id': 1, 'response': 'msgpack'},
+                        {'status': 'OK', 'msg_id': 2,
+                         'response': {'mac1': 'dev1'}}]
+        self.assertEqual({'mac1': 'dev1'}, self.utils.get_attached_vnics())
+        self.assertEqual('msgpack', self.utils.codec.name)
+        frames = [c[0][0][-1]
+                  for c in self.socket.send_multipart.call_args_list]
+        self.assertEqual({'action': 'negotiate_codec',
+                          'codecs': ['msgpack', 'json'], 'msg_id': 1},
+                         jsonutils.loads(frames[0]))
+        self.assertEqual({'action': 'get_vnics', 'fabric': '*',
+                          'msg_id': 2}, utils.msgpack.unpackb(frames[1]))
+
+    def test_codec_negotiation_unsupported(self):
+        if utils.msgpack is None:
+            self.skipTest("msgpack is not installed")
+        self.utils = utils.EswitchUtils('tcp://127.0.0.1:5001', 100)
+        self.replies = [{'status': 'FAIL', 'msg_id': 1,
+                         'action': 'negotiate_codec',
+                         'reason': 'unknown action'},
+                        {'status': 'OK', 'msg_id': 2}]
+        with mock.patch.object(utils, 'LOG') as log:
+            self.utils.port_up('fabric', 'mac1')
+        self.assertFalse(log.error.called)
+        self.assertEqual('json', self.utils.codec.name)
+        self.assertEqual(['negotiate_codec', 'port_up'],
+                         [m['action'] for m in self._sent_msgs()])
+
+    def test_subscribe_vnic_events_uses_shared_context(self):
+        self.utils.subscribe_vnic_events('tcp://127.0.0.1:5002')
+        self.context.socket.assert_called_once_with(zmq.SUB)
+        self.socket.connect.assert_called_once_with('tcp://127.0.0.1:5002')
+
+    def test_pipelined_replies_matched_by_msg_id(self):
+        first = self.utils.port_up('fabric', 'mac1', wait=False)
+        second = self.utils.port_down('fabric', 'mac2', wait=False)
+        self.replies = [{'status': 'OK', 'msg_id': 2, 'response': 'b'},
+                        {'status': 'OK', 'msg_id': 1, 'response': 'a'}]
+        self.assertEqual('a', first.wait())
+        self.assertTrue(second.ready())
+        self.assertEqual('b', second.wait())
+
+    def test_replies_without_msg_id_matched_in_order(self):
+        first = self.utils.port_up('fabric', 'mac1', wait=False)
+        second = self.utils.port_up('fabric', 'mac2', wait=False)
+        self.replies = [{'status': 'OK', 'response': 'a'},
+                        {'status': 'OK', 'response': 'b'}]
+        self.assertEqual('b', second.wait())
+        self.assertEqual('a', first.wait())
+
+    def test_failed_action_raises(self):
+        self.replies = [{'status': 'FAIL', 'msg_id': 1,
+                         'action': 'port_release', 'reason': 'no port'}]
+        e = self.assertRaises(exceptions.MlnxActionFailed,
+                              self.utils.port_release, 'fabric', 'mac')
+        self.assertIn('Action port_release failed: no port', str(e))
+
+    def test_unknown_status_raises(self):
+        self.replies = [{'status': 'BUSY', 'msg_id': 1}]
+        e = self.assertRaises(exceptions.MlnxException,
+                              self.utils.port_release, 'fabric', 'mac')
+        self.assertNotIsInstance(e, exceptions.MlnxActionFailed)
+        self.assertIn('Unknown operation status BUSY', str(e))
+
+    def test_timeout_fails_all_pending(self):
+        self.daemon_down = True
+        first = self.utils.port_up('fabric', 'mac1', wait=False)
+        second = self.utils.port_up('fabric', 'mac2', wait=False)
+        self.assertRaises(exceptions.MlnxException, first.wait)
+        self.assertTrue(second.ready())
+        self.assertRaises(exceptions.MlnxException, second.wait)
+        self.socket.close.assert_called_once_with()
+
+    def test_reconnect_keeps_context(self):
+        self.daemon_down = True
+        self.assertRaises(exceptions.MlnxException,
+                          self.utils.port_up, 'fabric', 'mac1')
+        self.replies = [{'status': 'OK', 'msg_id': 2}]
+        self.daemon_down = False
+        self.utils.port_up('fabric', 'mac1')
+        self.assertEqual(2, self.context.socket.call_count)
+        self.assertEqual(0, self.utils.failures)
+
+    def test_fails_fast_while_daemon_down(self):
+        self.daemon_down = True
+        with mock.patch('time.time', return_value=100):
+            for i in range(3):
+                self.assertRaises(exceptions.MlnxException,
+                                  self.utils.port_up, 'fabric', 'mac1')
+            self.assertFalse(self.utils.available())
+            self.assertRaises(exceptions.MlnxException,
+                              self.utils.port_up, 'fabric', 'mac1')
+        self.assertEqual(3, self.socket.send_multipart.call_count)
+        self.assertEqual(3, self.waits)
+
+    def test_wait_yields_to_other_greenthreads(self):
+        request = self.utils.port_up('fabric', 'mac1', wait=False)
+
+        def answer():
+            self.replies = [{'status': 'OK', 'msg_id': 1, 'response': 'a'}]
+
+        eventlet.spawn_n(answer)
+        self.assertEqual('a', request.wait())
+
+    def test_concurrent_waiters_share_receiver(self):
+        first = self.utils.port_up('fabric', 'mac1', wait=False)
+        second = self.utils.port_up('fabric', 'mac2', wait=False)
+        waiter = eventlet.spawn(second.wait)
+        # let the waiter start receiving
+        eventlet.sleep(0)
+        self.replies = [{'status': 'OK', 'msg_id': 1, 'response': 'a'},
+                        {'status': 'OK', 'msg_id': 2, 'response': 'b'}]
+        self.assertEqual('a', first.wait())
+        self.assertEqual('b', waiter.wait())
+        self.assertEqual(1, self.waits)
+
+    def test_reconnect_backoff_capped(self):
+        self.utils.reconnect_max_interval = 4
+        self.daemon_down = True
+        for now, delay in ((100, None), (101, None), (102, 1),
+                           (104, 2), (107, 4), (112, 4)):
+            with mock.patch('time.time', return_value=now):
+                self.assertRaises(exceptions.MlnxException,
+                                  self.utils.port_up, 'fabric', 'mac1')
+                if delay:
+                    self.assertFalse(self.utils.available())
+            if delay:
+                with mock.patch('time.time', return_value=now + delay):
+                    self.assertTrue(self.utils.available())
+        self.assertEqual(6, self.socket.send_multipart.call_count)
+
+    def test_batch_returns_status_per_action(self):
+        self.replies = [{'status': 'OK', 'msg_id': 1,
+                         'response': [{'status': 'OK'},
+                                      {'status': 'FAIL',
+                                       'action': 'port_up',
+                                       'reason': 'no vNIC'}]}]
+        requests = self.utils.batch([utils.set_vlan_msg('fabric', 3, 'mac'),
+                                     utils.port_up_msg('fabric', 'mac')])
+        self.assertEqual(1, self.socket.send_multipart.call_count)
+        self.assertEqual('batch', self._sent_msgs()[0]['action'])
+        self.assertIsNone(requests[0].wait())
+        self.assertRaises(exceptions.MlnxException, requests[1].wait)
+
+    def test_batch_falls_back_when_unsupported(self):
+        self.replies = [{'status': 'FAIL', 'msg_id': 1,
+                         'action': 'batch', 'reason': 'unknown action'},
+                        {'status': 'OK', 'msg_id': 2},
+                        {'status': 'OK', 'msg_id': 3}]
+        requests = self.utils.batch([utils.set_vlan_msg('fabric', 3, 'mac'),
+                                     utils.port_up_msg('fabric', 'mac')])
+        self.assertEqual([None, None], [r.wait() for r in requests])
+        self.assertFalse(self.utils.batch_supported)
+        self.assertEqual(['batch', 'set_vlan', 'port_up'],
+                         [m['action'] for m in self._sent_msgs()])
+
+    def test_batch_failure_fails_actions(self):
+        self.replies = [{'status': 'FAIL', 'msg_id': 1,
+                         'action': 'batch', 'reason': 'injected failure'}]
+        requests = self.utils.batch([utils.set_vlan_msg('fabric', 3, 'mac'),
+                                     utils.port_up_msg('fabric', 'mac')])
+        for request in requests:
+            self.assertRaises(exceptions.MlnxActionFailed, request.wait)
+        self.assertTrue(self.utils.batch_supported)
+        self.assertEqual(['batch'],
+                         [m['action'] for m in self._sent_msgs()])
+
+    def test_batch_fails_actions_not_answered(self):
+        self.replies = [{'status': 'OK', 'msg_id': 1,
+                         'response': [{'status': 'OK'}]}]
+        requests = self.utils.batch([utils.set_vlan_msg('fabric', 3, 'mac'),
+                                     utils.port_up_msg('fabric', 'mac')])
+        self.assertEqual(2, len(requests))
+        self.assertIsNone(requests[0].wait())
+        self.assertRaises(exceptions.MlnxException, requests[1].wait)
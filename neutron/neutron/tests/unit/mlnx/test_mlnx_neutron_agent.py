@@ -0,0 +1,495 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import shutil
+import tempfile
+
+import mock
+from oslo.config import cfg
+
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common.rpc import common as rpc_common
+from neutron.plugins.mlnx.agent import eswitch_neutron_agent
+from neutron.plugins.mlnx.agent import utils
+from neutron.plugins.mlnx.common import exceptions
+from neutron.tests import base
+
+
+class TestEswitchAgent(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestEswitchAgent, self).setUp()
+        # Avoid rpc initialization for unit tests
+        cfg.CONF.set_override('rpc_backend',
+                              'neutron.openstack.common.rpc.impl_fake')
+        cfg.CONF.set_default('firewall_driver',
+                             'neutron.agent.firewall.NoopFirewallDriver',
+                             group='SECURITYGROUP')
+        cfg.CONF.set_override('state_file', '', 'AGENT')
+        self.addCleanup(cfg.CONF.reset)
+        mock.patch('neutron.openstack.common.loopingcall.'
+                   'LoopingCall').start()
+        self.addCleanup(mock.patch.stopall)
+        with mock.patch.object(utils, 'zmq'):
+            self.agent = eswitch_neutron_agent.MlnxEswitchNeutronAgent({})
+        self.agent.plugin_rpc = mock.Mock()
+        self.agent.context = mock.Mock()
+        self.agent.agent_id = mock.Mock()
+        self.agent.eswitch = mock.Mock()
+        self.agent.eswitch.get_vnics_mac.return_value = set()
+
+    def _set_vnics(self, vnics):
+        with mock.patch.object(utils, 'EswitchUtils'):
+            self.agent.eswitch = eswitch_neutron_agent.EswitchManager(
+                {}, 'tcp://127.0.0.1:5001', 100)
+        get_vnics_delta = self.agent.eswitch.utils.get_vnics_delta
+        get_vnics_delta.return_value = {'generation': None,
+                                        'vnics': dict.fromkeys(vnics)}
+        self.agent.eswitch.get_vnics_mac()
+        return get_vnics_delta
+
+    def test_update_ports_from_events(self):
+        get_vnics_delta = self._set_vnics(['mac1', 'mac2'])
+        events = [{'event': utils.VNIC_ATTACHED, 'mac': 'mac3'},
+                  {'event': utils.VNIC_DETACHED, 'mac': 'mac1'},
+                  {'event': utils.VNIC_ATTACHED, 'mac': 'mac4'},
+                  {'event': utils.VNIC_DETACHED, 'mac': 'mac4'}]
+        port_info = self.agent.update_ports_from_events(
+            set(['mac1', 'mac2']), events)
+        self.assertEqual({'current': set(['mac2', 'mac3']),
+                          'added': set(['mac3']),
+                          'removed': set(['mac1'])}, port_info)
+        self.assertEqual(1, get_vnics_delta.call_count)
+
+    def test_update_ports_from_events_no_change(self):
+        self._set_vnics(['mac1'])
+        events = [{'event': utils.VNIC_ATTACHED, 'mac': 'mac1'}]
+        self.assertIsNone(
+            self.agent.update_ports_from_events(set(['mac1']), events))
+
+    def test_update_ports_from_events_failed_device(self):
+        # a device which failed is not registered and is added again
+        self._set_vnics(['mac1', 'mac2'])
+        port_info = self.agent.update_ports_from_events(set(['mac1']), [])
+        self.assertEqual(set(['mac2']), port_info['added'])
+
+    def test_failed_devices_retried_with_backoff(self):
+        port_info = {'current': set(['mac1', 'mac2']),
+                     'added': set(['mac1', 'mac2']),
+                     'removed': set(['mac3'])}
+        self.agent._schedule_retries(set(['mac1', 'mac3']), 100)
+        self.assertEqual({'current': set(['mac2', 'mac3']),
+                          'added': set(['mac2']),
+                          'removed': set()},
+                         self.agent._hold_back_retries(port_info, 101))
+        self.assertEqual(port_info,
+                         self.agent._hold_back_retries(port_info, 102))
+        self.agent._schedule_retries(set(['mac1']), 102)
+        self.assertEqual((2, 106), self.agent.retries['mac1'])
+
+    def test_retry_delay_capped(self):
+        self.agent.retries['mac1'] = (10, 0)
+        self.agent._schedule_retries(set(['mac1']), 100)
+        self.assertEqual((11, 160), self.agent.retries['mac1'])
+
+    def test_retries_forgotten_when_device_settled(self):
+        self.agent._schedule_retries(set(['mac1', 'mac2']), 100)
+        port_info = {'current': set(['mac1']),
+                     'added': set(['mac1']),
+                     'removed': set()}
+        self.assertIsNone(self.agent._hold_back_retries(port_info, 100))
+        self.assertEqual(['mac1'], self.agent.retries.keys())
+        self.assertIsNone(self.agent._hold_back_retries(None, 100))
+        self.assertEqual({}, self.agent.retries)
+
+    def test_treat_devices_added_binds_in_one_request(self):
+        details = {'device': 'mac1',
+                   'port_id': 'port1',
+                   'port_mac': 'mac1',
+                   'network_id': 'net1',
+                   'network_type': 'vlan',
+                   'physical_network': 'default',
+                   'vlan_id': 5,
+                   'admin_state_up': True}
+        self.agent.plugin_rpc.get_devices_details_list.return_value = [
+            details]
+        self.agent.eswitch.get_vnics_mac.return_value = set(['mac1'])
+        self.agent.eswitch.bind_ports.return_value = set()
+        self.assertEqual(set(),
+                         self.agent.treat_devices_added(set(['mac1'])))
+        self.agent.eswitch.bind_ports.assert_called_once_with([details])
+
+    def test_treat_devices_added_bind_failure(self):
+        details = {'device': 'mac1',
+                   'port_id': 'port1',
+                   'port_mac': 'mac1',
+                   'admin_state_up': True}
+        self.agent.plugin_rpc.get_devices_details_list.return_value = [
+            details]
+        self.agent.eswitch.get_vnics_mac.return_value = set(['mac1'])
+        self.agent.eswitch.bind_ports.return_value = set(['mac1'])
+        self.assertEqual(set(['mac1']),
+                         self.agent.treat_devices_added(set(['mac1'])))
+
+    def test_get_devices_details_list(self):
+        rpc = self.agent.plugin_rpc
+        rpc.get_devices_details_list.return_value = [{'device': 'mac1'}]
+        self.assertEqual(([{'device': 'mac1'}], set()),
+                         self.agent.get_devices_details(set(['mac1'])))
+        self.assertFalse(rpc.get_device_details.called)
+
+    def test_get_devices_details_old_plugin(self):
+        rpc = self.agent.plugin_rpc
+        rpc.get_devices_details_list.side_effect = rpc_common.RemoteError(
+            'UnsupportedRpcVersion')
+        rpc.get_device_details.return_value = {'device': 'mac1'}
+        self.assertEqual(([{'device': 'mac1'}], set()),
+                         self.agent.get_devices_details(set(['mac1'])))
+        self.assertFalse(self.agent.devices_details_list_supported)
+        self.agent.get_devices_details(set(['mac1']))
+        self.assertEqual(1, rpc.get_devices_details_list.call_count)
+
+    def test_get_devices_details_old_plugin_failed_devices(self):
+        rpc = self.agent.plugin_rpc
+        self.agent.devices_details_list_supported = False
+
+        def get_device_details(context, device, agent_id):
+            if device == 'mac2':
+                raise rpc_common.Timeout()
+            return {'device': device}
+
+        rpc.get_device_details.side_effect = get_device_details
+        details, failed = self.agent.get_devices_details(['mac1', 'mac2',
+                                                          'mac3'])
+        self.assertEqual([{'device': 'mac1'}, {'device': 'mac3'}], details)
+        self.assertEqual(set(['mac2']), failed)
+
+    def test_get_devices_details_list_failure(self):
+        rpc = self.agent.plugin_rpc
+        rpc.get_devices_details_list.side_effect = rpc_common.Timeout()
+        self.assertEqual(([], set(['mac1'])),
+                         self.agent.get_devices_details(set(['mac1'])))
+        self.assertTrue(self.agent.devices_details_list_supported)
+
+    def test_treat_devices_removed(self):
+        rpc = self.agent.plugin_rpc
+        self.agent.eswitch.get_port_id_by_mac.return_value = 'port1'
+        rpc.update_devices_down.return_value = [{'device': 'port1',
+                                                 'exists': True}]
+        self.agent.eswitch.release_ports.return_value = {}
+        self.assertEqual(set(),
+                         self.agent.treat_devices_removed(set(['mac1'])))
+        rpc.update_devices_down.assert_called_once_with(
+            self.agent.context, ['port1'], self.agent.agent_id)
+        self.agent.eswitch.release_ports.assert_called_once_with(
+            {'mac1': 'port1'})
+
+    def test_treat_devices_removed_rpc_failure(self):
+        rpc = self.agent.plugin_rpc
+        self.agent.eswitch.get_port_id_by_mac.return_value = 'port1'
+        rpc.update_devices_down.side_effect = rpc_common.Timeout()
+        self.assertEqual(set(['mac1']),
+                         self.agent.treat_devices_removed(set(['mac1'])))
+        self.assertFalse(self.agent.eswitch.release_ports.called)
+
+    def test_treat_devices_removed_release_failure(self):
+        rpc = self.agent.plugin_rpc
+        self.agent.eswitch.get_port_id_by_mac.side_effect = lambda mac: mac
+        rpc.update_devices_down.return_value = []
+
+        self.agent.eswitch.release_ports.return_value = {
+            'mac2': exceptions.MlnxException(err_msg=_("timeout"))}
+        self.assertEqual(set(['mac2']),
+                         self.agent.treat_devices_removed(
+                             set(['mac1', 'mac2'])))
+        self.assertEqual(1, self.agent.eswitch.release_ports.call_count)
+
+    def test_update_devices_status_old_plugin(self):
+        rpc = self.agent.plugin_rpc
+        rpc.update_devices_up.side_effect = rpc_common.RemoteError(
+            'UnsupportedRpcVersion')
+        self.agent.update_devices_status(['mac1', 'mac2'], up=True)
+        self.assertEqual(2, rpc.update_device_up.call_count)
+        self.assertFalse(self.agent.devices_status_list_supported)
+
+    def test_ports_update(self):
+        callbacks = eswitch_neutron_agent.MlnxEswitchRpcCallbacks(
+            self.agent.context, self.agent)
+        ports = [{'port': {'id': 'port1'}, 'network_type': 'vlan'},
+                 {'port': {'id': 'port2'}, 'network_type': 'vlan'}]
+        with mock.patch.object(callbacks, 'port_update') as port_update:
+            callbacks.ports_update(self.agent.context, ports=ports)
+        port_update.assert_has_calls(
+            [mock.call(self.agent.context, **kwargs) for kwargs in ports])
+
+    def test_queued_devices_status_sent_together(self):
+        rpc = self.agent.plugin_rpc
+        with mock.patch('eventlet.spawn_after') as spawn_after:
+            self.agent.queue_device_status('mac1', True)
+            self.agent.queue_device_status('mac2', True)
+            self.agent.queue_device_status('mac3', False)
+            self.assertEqual(1, spawn_after.call_count)
+        self.agent._send_devices_status()
+        self.assertEqual(set(['mac1', 'mac2']),
+                         set(rpc.update_devices_up.call_args[0][1]))
+        rpc.update_devices_down.assert_called_once_with(
+            self.agent.context, ['mac3'], self.agent.agent_id)
+        self.assertEqual({}, self.agent.devices_status)
+
+    def _run_daemon_loop(self, iterations):
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == iterations:
+                raise StopIteration()
+
+        with contextlib.nested(
+            mock.patch('time.time', return_value=100),
+            mock.patch('time.sleep', side_effect=sleep)
+        ):
+            self.assertRaises(StopIteration, self.agent.daemon_loop)
+        return sleeps
+
+    def test_daemon_loop_backs_off_when_idle(self):
+        self.agent._polling_interval = 2
+        self.agent._max_polling_interval = 10
+        self.agent.eswitch.get_vnics_mac.side_effect = [
+            set(), set(), set(), set(['mac1']), set(['mac1'])]
+        self.agent.process_network_ports = mock.Mock(return_value=set())
+        self.assertEqual([4, 8, 10, 2, 4], self._run_daemon_loop(5))
+        metrics = self.agent.loop_metrics
+        self.assertEqual(5, metrics['iterations'])
+        self.assertEqual(1, metrics['devices_added'])
+        self.assertEqual(5, metrics['durations']['0.1'])
+
+    def test_daemon_loop_no_backoff_by_default(self):
+        self.assertEqual(2, self.agent._max_polling_interval)
+        self.agent.eswitch.get_vnics_mac.return_value = set()
+        self.agent.process_network_ports = mock.Mock(return_value=set())
+        self.assertEqual([2, 2, 2], self._run_daemon_loop(3))
+
+    def _use_state_file(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        state_file = os.path.join(state_dir, 'state.json')
+        cfg.CONF.set_override('state_file', state_file, 'AGENT')
+        return state_file
+
+    def test_save_and_load_state(self):
+        self._use_state_file()
+        self.agent.eswitch.get_state.return_value = {'network_map': {},
+                                                     'port_map': {}}
+        self.agent._save_state(set(['mac1', 'mac2']))
+        self.assertEqual(set(['mac1', 'mac2']), self.agent._load_state())
+        self.agent.eswitch.restore_state.assert_called_once_with(
+            {'network_map': {}, 'port_map': {}})
+
+    def test_load_state_other_version(self):
+        state_file = self._use_state_file()
+        with open(state_file, 'w') as f:
+            f.write('{"version": 0, "ports": []}')
+        self.assertIsNone(self.agent._load_state())
+        self.assertFalse(self.agent.eswitch.restore_state.called)
+
+    def test_load_state_missing(self):
+        self._use_state_file()
+        self.assertIsNone(self.agent._load_state())
+
+    def test_record_iteration(self):
+        port_info = {'current': set(['mac1']),
+                     'added': set(['mac1']),
+                     'removed': set(['mac2'])}
+        self.agent._record_iteration(3, 2, port_info, set(['mac1']))
+        self.agent._record_iteration(60, 2, None, set())
+        metrics = self.agent.loop_metrics
+        self.assertEqual(2, metrics['iterations'])
+        self.assertEqual(2, metrics['overruns'])
+        self.assertEqual(1, metrics['devices_added'])
+        self.assertEqual(1, metrics['devices_removed'])
+        self.assertEqual(1, metrics['devices_failed'])
+        self.assertEqual(1, metrics['durations']['5'])
+        self.assertEqual(1, metrics['durations']['inf'])
+
+
+class TestEswitchManager(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestEswitchManager, self).setUp()
+        with mock.patch.object(utils, 'EswitchUtils'):
+            self.manager = eswitch_neutron_agent.EswitchManager(
+                {}, 'tcp://127.0.0.1:5001', 100)
+        self.utils = self.manager.utils
+        self.utils.batch.side_effect = lambda msgs: [mock.Mock()
+                                                     for msg in msgs]
+
+    def _set_vnics(self, vnics):
+        self.utils.get_vnics_delta.return_value = {'generation': 1,
+                                                   'vnics': vnics}
+
+    def _port_up(self, network_id, port_id, port_mac):
+        self.manager.port_up(network_id, 'vlan', 'default', 5,
+                             port_id, port_mac)
+
+    def test_port_up_indexes_port(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self.assertEqual('port1', self.manager.get_port_id_by_mac('mac1'))
+        self.assertEqual('mac1', self.manager.get_port_mac_by_id('port1'))
+        self.assertEqual(set(['mac1']),
+                         self.manager.network_map['net1']['ports'])
+
+    def test_port_up_twice_keeps_one_entry(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self._port_up('net2', 'port1', 'mac1')
+        self.assertEqual(set(), self.manager.network_map['net1']['ports'])
+        self.assertEqual(set(['mac1']),
+                         self.manager.network_map['net2']['ports'])
+        self.assertEqual(1, len(self.manager.port_map))
+
+    def _sent_actions(self):
+        return [msg['action'] for call in self.utils.batch.call_args_list
+                for msg in call[0][0]]
+
+    def test_port_up_skipped_when_programmed(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self._port_up('net1', 'port1', 'mac1')
+        self.assertEqual(['set_vlan', 'port_up'], self._sent_actions())
+        self.assertEqual(2, self.manager.skipped_ops)
+
+    def test_port_up_sent_when_vlan_changed(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self.manager.port_up('net2', 'vlan', 'default', 6, 'port1', 'mac1')
+        self.assertEqual(['set_vlan', 'port_up', 'set_vlan'],
+                         self._sent_actions())
+        self.assertEqual((6, True), self.manager.programmed['mac1'])
+        self.assertEqual(1, self.manager.skipped_ops)
+
+    def test_only_port_up_sent_when_port_down(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self.manager.port_down('net1', 'default', 'mac1')
+        self._port_up('net1', 'port1', 'mac1')
+        self.assertEqual(['set_vlan', 'port_up', 'port_down', 'port_up'],
+                         self._sent_actions())
+        self.assertEqual((5, True), self.manager.programmed['mac1'])
+        self.assertEqual(1, self.manager.skipped_ops)
+
+    def test_port_down_skipped_when_programmed(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self.manager.port_down('net1', 'default', 'mac1')
+        self.manager.port_down('net1', 'default', 'mac1')
+        self.assertEqual(['set_vlan', 'port_up', 'port_down'],
+                         self._sent_actions())
+        self.assertEqual(1, self.manager.skipped_ops)
+
+    def test_failure_forgets_programmed_state(self):
+        self._port_up('net1', 'port1', 'mac1')
+        failed = mock.Mock()
+        failed.wait.side_effect = exceptions.MlnxException(err_msg='fail')
+        self.utils.batch.side_effect = lambda msgs: [failed for msg in msgs]
+        self.assertRaises(exceptions.MlnxException, self.manager.port_down,
+                          'net1', 'default', 'mac1')
+        self.assertNotIn('mac1', self.manager.programmed)
+        self.utils.batch.side_effect = lambda msgs: [mock.Mock()
+                                                     for msg in msgs]
+        self._port_up('net1', 'port1', 'mac1')
+        self.assertEqual(['set_vlan', 'port_up', 'port_down',
+                          'set_vlan', 'port_up'], self._sent_actions())
+
+    def test_port_release_removes_port(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self.manager.port_release('mac1')
+        self.utils.batch.assert_called_with(
+            [utils.port_release_msg('default', 'mac1')])
+        self.assertRaises(exceptions.MlnxException,
+                          self.manager.get_port_id_by_mac, 'mac1')
+        self.assertIsNone(self.manager.get_port_mac_by_id('port1'))
+
+    def test_port_release_unknown_port(self):
+        self.manager.port_release('mac1')
+        self.assertNotIn('port_release', self._sent_actions())
+
+    def test_release_ports_in_one_batch(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self._port_up('net1', 'port2', 'mac2')
+        failed = mock.Mock()
+        failed.wait.side_effect = exceptions.MlnxException(err_msg='fail')
+        self.utils.batch.side_effect = lambda msgs: [mock.Mock(), failed]
+        errors = self.manager.release_ports(['mac1', 'mac2', 'mac3'])
+        self.assertEqual(['mac2'], errors.keys())
+        self.utils.batch.assert_called_with(
+            [utils.port_release_msg('default', 'mac1'),
+             utils.port_release_msg('default', 'mac2')])
+        self.assertEqual(['mac2'], self.manager.port_map.keys())
+
+    def test_remove_network_removes_ports(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self.manager.remove_network('net1')
+        self.assertEqual({}, self.manager.port_map)
+        self.assertEqual({}, self.manager.port_id_map)
+
+    def test_vnic_port_exists_uses_snapshot(self):
+        self.manager.vnics_max_age = 60
+        self._set_vnics({'mac1': 'dev1'})
+        with mock.patch('time.time', return_value=100):
+            self.assertTrue(self.manager.vnic_port_exists('mac1'))
+            self.assertFalse(self.manager.vnic_port_exists('mac2'))
+        self.assertEqual(1, self.utils.get_vnics_delta.call_count)
+        with mock.patch('time.time', return_value=161):
+            self.assertTrue(self.manager.vnic_port_exists('mac1'))
+        self.assertEqual(2, self.utils.get_vnics_delta.call_count)
+
+    def test_get_vnics_mac_forced_refresh(self):
+        self._set_vnics({'mac1': 'dev1'})
+        self.manager.get_vnics_mac()
+        self._set_vnics({'mac2': 'dev2'})
+        self.assertEqual(set(['mac2']), self.manager.get_vnics_mac())
+
+    def test_get_vnics_mac_applies_delta(self):
+        self._set_vnics({'mac1': 'dev1', 'mac2': 'dev2'})
+        self.manager.get_vnics_mac()
+        self.utils.get_vnics_delta.return_value = {
+            'generation': 2, 'added': {'mac3': 'dev3'}, 'removed': ['mac1']}
+        self.assertEqual(set(['mac2', 'mac3']), self.manager.get_vnics_mac())
+        self.assertEqual([mock.call(None), mock.call(1)],
+                         self.utils.get_vnics_delta.call_args_list)
+        self.assertEqual(2, self.manager.vnics_generation)
+
+    def test_update_vnics_from_events(self):
+        self.manager.vnics_max_age = 60
+        self._set_vnics({'mac1': 'dev1'})
+        self.manager.get_vnics_mac()
+        self.manager.update_vnics([{'event': utils.VNIC_ATTACHED,
+                                    'mac': 'mac2'},
+                                   {'event': utils.VNIC_DETACHED,
+                                    'mac': 'mac1'}])
+        self.assertEqual(set(['mac2']), self.manager.get_vnics_mac(60))
+        self.assertEqual(1, self.utils.get_vnics_delta.call_count)
+
+    def test_state_round_trip(self):
+        self._port_up('net1', 'port1', 'mac1')
+        self.assertTrue(self.manager.state_changed)
+        state = jsonutils.loads(jsonutils.dumps(self.manager.get_state()))
+        self.assertFalse(self.manager.state_changed)
+        with mock.patch.object(utils, 'EswitchUtils'):
+            manager = eswitch_neutron_agent.EswitchManager(
+                {}, 'tcp://127.0.0.1:5001', 100)
+        manager.restore_state(state)
+        self.assertEqual(self.manager.network_map, manager.network_map)
+        self.assertEqual(self.manager.port_map, manager.port_map)
+        self.assertEqual('mac1', manager.get_port_mac_by_id('port1'))
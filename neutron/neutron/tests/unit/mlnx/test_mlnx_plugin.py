@@ -13,7 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+
+import mock
+from sqlalchemy import event
+
+from neutron.db import api as db_api
 from neutron.plugins.mlnx.common import constants
+from neutron.plugins.mlnx.db import mlnx_db_v2 as db
 from neutron.tests.unit import _test_extension_portbindings as test_bindings
 from neutron.tests.unit import test_db_plugin as test_plugin
 from neutron.tests.unit import test_security_groups_rpc as test_sg_rpc
@@ -29,6 +36,30 @@ class MlnxPluginV2TestCase(test_plugin.NeutronDbPluginV2TestCase):
         super(MlnxPluginV2TestCase, self).setUp(self._plugin_name)
         self.port_create_status = 'DOWN'
 
+    def _list_counting_statements(self, resource):
+        """List resources, counting the SQL statements it takes.
+
+        The network binding cache, filled when the networks were created,
+        is cleared so the bindings are queried.
+        """
+        db.network_binding_cache.clear()
+        statements = []
+        counting = [True]
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            if counting:
+                statements.append(statement)
+
+        event.listen(db_api.get_session().bind, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            res = self._list(resource)
+        finally:
+            # listeners can not be removed with SQLAlchemy 0.7
+            del counting[:]
+        return res[resource], len(statements)
+
 
 class TestMlnxBasicGet(test_plugin.TestBasicGet, MlnxPluginV2TestCase):
     pass
@@ -41,11 +72,72 @@ class TestMlnxV2HTTPResponse(test_plugin.TestV2HTTPResponse,
 
 class TestMlnxPortsV2(test_plugin.TestPortsV2,
                       MlnxPluginV2TestCase):
-    pass
+
+    def test_list_ports_query_count_independent_of_size(self):
+        with self.network() as net:
+            with self.port(network=net):
+                ports, one_port_queries = self._list_counting_statements(
+                    'ports')
+                self.assertEqual(1, len(ports))
+                with contextlib.nested(self.port(network=net),
+                                       self.port(network=net)):
+                    ports, queries = self._list_counting_statements('ports')
+                    self.assertEqual(3, len(ports))
+                    self.assertEqual(one_port_queries, queries)
+                    for port in ports:
+                        self.assertEqual(
+                            {'physical_network': 'default'},
+                            port['binding:profile'])
+
+    def test_list_ports_loads_bindings_in_bulk(self):
+        with self.network() as net:
+            with contextlib.nested(self.port(network=net),
+                                   self.port(network=net)):
+                db.network_binding_cache.clear()
+                with contextlib.nested(
+                        mock.patch.object(db, 'get_network_binding'),
+                        mock.patch.object(db, 'get_port_profile_binding')
+                ) as (get_binding, get_profile):
+                    ports = self._list('ports')['ports']
+                self.assertEqual(2, len(ports))
+                self.assertFalse(get_binding.called)
+                self.assertFalse(get_profile.called)
 
 
 class TestMlnxNetworksV2(test_plugin.TestNetworksV2, MlnxPluginV2TestCase):
-    pass
+
+    def test_list_networks_query_count_independent_of_size(self):
+        with self.network(name='net1') as net1:
+            nets, one_net_queries = self._list_counting_statements(
+                'networks')
+            self.assertEqual(1, len(nets))
+            with contextlib.nested(self.network(name='net2'),
+                                   self.network(name='net3')) as (net2,
+                                                                  net3):
+                nets, queries = self._list_counting_statements('networks')
+                self.assertEqual(3, len(nets))
+                self.assertEqual(one_net_queries, queries)
+                segmentation_ids = dict(
+                    (net['id'], net['provider:segmentation_id'])
+                    for net in nets)
+                for net in (net1, net2, net3):
+                    net = net['network']
+                    self.assertEqual(net['provider:segmentation_id'],
+                                     segmentation_ids[net['id']])
+
+    def test_list_networks_loads_bindings_in_bulk(self):
+        with contextlib.nested(self.network(name='net1'),
+                               self.network(name='net2')):
+            db.network_binding_cache.clear()
+            bulk_patch = mock.patch.object(db, 'get_network_bindings',
+                                           wraps=db.get_network_bindings)
+            with contextlib.nested(
+                    mock.patch.object(db, 'get_network_binding'),
+                    bulk_patch) as (get_binding, get_bindings):
+                nets = self._list('networks')['networks']
+            self.assertEqual(2, len(nets))
+            self.assertFalse(get_binding.called)
+            self.assertEqual(1, get_bindings.call_count)
 
 
 class TestMlnxPortBinding(MlnxPluginV2TestCase,
@@ -0,0 +1,100 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+
+import mock
+
+from neutron.plugins.mlnx.db import mlnx_db_v2 as db
+from neutron.plugins.mlnx import rpc_callbacks
+from neutron.tests import base
+
+PORT_ID = '12345678-1234-1234-1234-123456789012'
+PORT_MAC = 'fa:16:3e:00:00:01'
+
+
+class TestMlnxRpcCallbacks(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestMlnxRpcCallbacks, self).setUp()
+        self.get_by_id = mock.patch.object(db, 'get_port_from_device').start()
+        self.get_by_mac = mock.patch.object(db,
+                                            'get_port_from_device_mac').start()
+        self.addCleanup(mock.patch.stopall)
+        self.callbacks = rpc_callbacks.MlnxRpcCallbacks()
+
+    def test_get_port_from_device_by_mac(self):
+        self.get_by_mac.return_value = {'id': PORT_ID}
+        port = self.callbacks.get_port_from_device(PORT_MAC)
+        self.get_by_mac.assert_called_once_with(PORT_MAC)
+        self.assertFalse(self.get_by_id.called)
+        self.assertEqual(PORT_MAC, port['device'])
+
+    def test_get_port_from_device_by_tap_name(self):
+        self.get_by_id.return_value = {'id': PORT_ID}
+        port = self.callbacks.get_port_from_device('tap' + PORT_ID[:11])
+        self.get_by_id.assert_called_once_with(PORT_ID[:11])
+        self.assertFalse(self.get_by_mac.called)
+        self.assertEqual('tap' + PORT_ID[:11], port['device'])
+
+    def test_get_port_from_device_by_port_id(self):
+        self.get_by_id.return_value = None
+        self.assertIsNone(self.callbacks.get_port_from_device(PORT_ID))
+        self.get_by_id.assert_called_once_with(PORT_ID)
+        self.assertFalse(self.get_by_mac.called)
+
+    def test_get_devices_details_list_unbound_network(self):
+        port = {'id': PORT_ID, 'mac_address': PORT_MAC,
+                'network_id': 'net1', 'admin_state_up': True,
+                'status': 'ACTIVE'}
+        unbound_mac = 'fa:16:3e:00:00:02'
+        unbound = dict(port, id='port2', mac_address=unbound_mac,
+                       network_id='net2')
+        binding = mock.Mock(physical_network='default',
+                            network_type='vlan', segmentation_id=5)
+        with mock.patch.object(db, 'get_ports_and_bindings_by_id_or_mac',
+                               return_value=[(port, binding),
+                                             (unbound, None)]):
+            entries = self.callbacks.get_devices_details_list(
+                None, devices=[PORT_MAC, unbound_mac], agent_id='agent')
+        self.assertEqual(PORT_ID, entries[0]['port_id'])
+        self.assertEqual(5, entries[0]['segmentation_id'])
+        self.assertEqual({'device': unbound_mac}, entries[1])
+
+    def test_get_devices_details_list_single_lookup_only_for_tap(self):
+        tap = 'tap' + PORT_ID[:11]
+        self.get_by_id.return_value = None
+        with mock.patch.object(db, 'get_ports_and_bindings_by_id_or_mac',
+                               return_value=[]):
+            entries = self.callbacks.get_devices_details_list(
+                None, devices=[PORT_MAC, PORT_ID, tap], agent_id='agent')
+        self.assertEqual([{'device': PORT_MAC}, {'device': PORT_ID},
+                          {'device': tap}], entries)
+        self.get_by_id.assert_called_once_with(PORT_ID[:11])
+        self.assertFalse(self.get_by_mac.called)
+
+    def test_update_devices_up_single_lookup_only_for_tap(self):
+        tap = 'tap' + PORT_ID[:11]
+        self.get_by_id.return_value = None
+        with contextlib.nested(
+                mock.patch.object(db, 'get_ports_by_id_or_mac',
+                                  return_value=[]),
+                mock.patch.object(db, 'set_ports_status')):
+            self.callbacks.update_devices_up(
+                None, devices=[PORT_MAC, PORT_ID, tap], agent_id='agent')
+        self.get_by_id.assert_called_once_with(PORT_ID[:11])
+        self.assertFalse(self.get_by_mac.called)
@@ -94,6 +94,12 @@ class TestMlnxSecurityGroupsDB(MlnxSecurityGroupsTestCase):
                                      port_dict['fixed_ips'])
                     self._delete('ports', port['port']['id'])
 
+    def test_security_group_get_port_from_device_by_port_id(self):
+        with self.port() as port:
+            port_id = port['port']['id']
+            port_dict = mlnx_db.get_port_from_device(port_id)
+            self.assertEqual(port_id, port_dict['id'])
+
     def test_security_group_get_port_from_device_with_no_port(self):
         port_dict = mlnx_db.get_port_from_device('bad_device_id')
         self.assertEqual(None, port_dict)
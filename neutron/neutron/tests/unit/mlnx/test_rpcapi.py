@@ -19,6 +19,9 @@
 Unit Tests for Mellanox RPC (major reuse of linuxbridge rpc unit tests)
 """
 
+import contextlib
+
+import mock
 from oslo.config import cfg
 import stubout
 
@@ -26,6 +29,7 @@ from neutron.agent import rpc as agent_rpc
 from neutron.common import topics
 from neutron.openstack.common import context
 from neutron.openstack.common import rpc
+from neutron.plugins.mlnx.agent import eswitch_neutron_agent
 from neutron.plugins.mlnx import agent_notify_api
 from neutron.tests import base
 
@@ -33,12 +37,12 @@ from neutron.tests import base
 class rpcApiTestCase(base.BaseTestCase):
 
     def _test_mlnx_api(self, rpcapi, topic, method, rpc_method,
-                       expected_msg=None, **kwargs):
+                       expected_msg=None, version=None, **kwargs):
         ctxt = context.RequestContext('fake_user', 'fake_project')
         expected_retval = 'foo' if method == 'call' else None
         if not expected_msg:
             expected_msg = rpcapi.make_msg(method, **kwargs)
-        expected_msg['version'] = rpcapi.BASE_RPC_API_VERSION
+        expected_msg['version'] = version or rpcapi.BASE_RPC_API_VERSION
         if rpc_method == 'cast' and method == 'run_instance':
             kwargs['call'] = False
 
@@ -129,6 +133,55 @@ class rpcApiTestCase(base.BaseTestCase):
                             physical_network='fake_net',
                             vlan_id='fake_vlan_id')
 
+    def test_port_update_to_host_coalesced(self):
+        cfg.CONF.set_override('rpc_support_old_agents', False, 'AGENT')
+        cfg.CONF.set_override('port_update_to_host', True, 'MLNX')
+        self.addCleanup(cfg.CONF.reset)
+        rpcapi = agent_notify_api.AgentNotifierApi(topics.AGENT)
+        ctxt = context.RequestContext('fake_user', 'fake_project')
+        port1 = {'id': 'port1', 'binding:host_id': 'host1'}
+        port2 = {'id': 'port2', 'binding:host_id': 'host1'}
+        unbound_port = {'id': 'port3'}
+        with contextlib.nested(
+            mock.patch('eventlet.spawn_after'),
+            mock.patch.object(rpc, 'cast'),
+            mock.patch.object(rpc, 'fanout_cast')
+        ) as (spawn_after, cast, fanout_cast):
+            for port in (port1, port2, port1, unbound_port):
+                rpcapi.port_update(ctxt, port, 'fake_net', 'vlan', 5)
+            self.assertEqual(1, spawn_after.call_count)
+            self.assertEqual(1, fanout_cast.call_count)
+            self.assertFalse(cast.called)
+            rpcapi._send_port_updates()
+        topic = topics.get_topic_name(topics.AGENT, topics.PORT,
+                                      topics.UPDATE) + '.host1'
+        self.assertEqual(topic, cast.call_args[0][1])
+        msg = cast.call_args[0][2]
+        self.assertEqual('ports_update', msg['method'])
+        self.assertEqual('1.2', msg['version'])
+        self.assertEqual(set(['port1', 'port2']),
+                         set(p['port']['id'] for p in msg['args']['ports']))
+        self.assertTrue(cast.call_args[0][0].is_admin)
+        self.assertEqual({}, rpcapi.pending_port_updates)
+
+    def test_port_updates_sent_to_other_hosts_after_failure(self):
+        cfg.CONF.set_override('port_update_to_host', True, 'MLNX')
+        self.addCleanup(cfg.CONF.reset)
+        rpcapi = agent_notify_api.AgentNotifierApi(topics.AGENT)
+        ctxt = context.RequestContext('fake_user', 'fake_project')
+        with contextlib.nested(
+            mock.patch('eventlet.spawn_after'),
+            mock.patch.object(rpc, 'cast',
+                              side_effect=[Exception(), None])
+        ) as (spawn_after, cast):
+            for host in ('host1', 'host2'):
+                rpcapi.port_update(ctxt, {'id': host + '_port',
+                                          'binding:host_id': host},
+                                   'fake_net', 'vlan', 5)
+            rpcapi._send_port_updates()
+        self.assertEqual(2, cast.call_count)
+        self.assertEqual({}, rpcapi.pending_port_updates)
+
     def test_device_details(self):
         rpcapi = agent_rpc.PluginApi(topics.PLUGIN)
         self._test_mlnx_api(rpcapi, topics.PLUGIN,
@@ -136,6 +189,14 @@ class rpcApiTestCase(base.BaseTestCase):
                             device='fake_device',
                             agent_id='fake_agent_id')
 
+    def test_devices_details_list(self):
+        rpcapi = eswitch_neutron_agent.MlnxEswitchPluginApi(topics.PLUGIN)
+        self._test_mlnx_api(rpcapi, topics.PLUGIN,
+                            'get_devices_details_list', rpc_method='call',
+                            version='1.2',
+                            devices=['fake_device1', 'fake_device2'],
+                            agent_id='fake_agent_id')
+
     def test_update_device_down(self):
         rpcapi = agent_rpc.PluginApi(topics.PLUGIN)
         self._test_mlnx_api(rpcapi, topics.PLUGIN,
@@ -143,6 +204,22 @@ class rpcApiTestCase(base.BaseTestCase):
                             device='fake_device',
                             agent_id='fake_agent_id')
 
+    def test_update_devices_down(self):
+        rpcapi = eswitch_neutron_agent.MlnxEswitchPluginApi(topics.PLUGIN)
+        self._test_mlnx_api(rpcapi, topics.PLUGIN,
+                            'update_devices_down', rpc_method='call',
+                            version='1.3',
+                            devices=['fake_device1', 'fake_device2'],
+                            agent_id='fake_agent_id')
+
+    def test_update_devices_up(self):
+        rpcapi = eswitch_neutron_agent.MlnxEswitchPluginApi(topics.PLUGIN)
+        self._test_mlnx_api(rpcapi, topics.PLUGIN,
+                            'update_devices_up', rpc_method='call',
+                            version='1.3',
+                            devices=['fake_device1', 'fake_device2'],
+                            agent_id='fake_agent_id')
+
     def test_update_device_up(self):
         rpcapi = agent_rpc.PluginApi(topics.PLUGIN)
         self._test_mlnx_api(rpcapi, topics.PLUGIN,
@@ -0,0 +1,192 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Client of the Mellanox eSwitch daemon, sending the requests ebrctl
+    sends without running a process for each of them.
+"""
+import eventlet
+from eventlet.green import zmq
+from eventlet import pools
+
+from nova import exception
+from nova.openstack.common.gettextutils import _
+from nova.openstack.common import jsonutils
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class EswitchdError(exception.NovaException):
+    """eSwitchD failed the action."""
+
+
+class EswitchdUnavailable(exception.NovaException):
+    """The request could not be sent to eSwitchD."""
+
+
+class EswitchdTimeout(exception.NovaException):
+    """eSwitchD did not answer a request sent to it.
+
+    The action may have been done, so it must not be sent again.
+    """
+
+
+def create_port_msg(vnic_mac, device_id, fabric, vnic_type, dev_name=None):
+    """Allocate a device to the vNIC, as ebrctl allocate-port."""
+    return {'action': 'create_port',
+            'vnic_mac': vnic_mac,
+            'device_id': device_id,
+            'fabric': fabric,
+            'vnic_type': vnic_type,
+            'dev_name': dev_name}
+
+
+def plug_nic_msg(vnic_mac, device_id, fabric, vnic_type, dev_name):
+    """Plug the vNIC, as ebrctl add-port."""
+    return {'action': 'plug_nic',
+            'vnic_mac': vnic_mac,
+            'device_id': device_id,
+            'fabric': fabric,
+            'vnic_type': vnic_type,
+            'dev_name': dev_name}
+
+
+def delete_port_msg(fabric, vnic_mac):
+    """Release the device of the vNIC, as ebrctl del-port."""
+    return {'action': 'delete_port',
+            'fabric': fabric,
+            'vnic_mac': vnic_mac}
+
+
+class SocketPool(pools.Pool):
+    """Pool of REQ sockets connected to eSwitchD.
+
+    All of them share the process ZMQ context. A socket is only put back
+    in the pool once it got its answer, as a REQ socket can not send
+    again before. Sockets only queue requests to a connected daemon, so a
+    request which could not be sent was not received either.
+    """
+
+    def __init__(self, endpoint, max_size):
+        self.endpoint = endpoint
+        super(SocketPool, self).__init__(min_size=1, max_size=max_size)
+
+    def create(self):
+        socket = zmq.Context.instance().socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        # not supported before ZMQ 3.3, requests are then queued until
+        # the daemon is connected
+        if hasattr(zmq, 'IMMEDIATE'):
+            socket.setsockopt(zmq.IMMEDIATE, 1)
+        socket.connect(self.endpoint)
+        return socket
+
+
+class EswitchdClient(object):
+    """Sends ebrctl's requests to eSwitchD over pooled ZMQ sockets."""
+
+    def __init__(self, endpoint, timeout, pool_size):
+        self.timeout = timeout
+        self.pool = SocketPool(endpoint, pool_size)
+        self.batch_supported = True
+
+    def send_msg(self, msg):
+        """Send a request to eSwitchD and wait for its answer.
+
+        :param msg: request dict
+        :returns: the response of the daemon
+        :raises: EswitchdError if the action failed, EswitchdUnavailable
+                 if the request could not be sent in time, EswitchdTimeout
+                 if the daemon did not answer it in time
+        """
+        socket = self.pool.get()
+        timeout = eventlet.Timeout(self.timeout / 1000.0)
+        sent = False
+        try:
+            socket.send(jsonutils.dumps(msg))
+            sent = True
+            recv_msg = socket.recv()
+        except (eventlet.Timeout, zmq.ZMQError) as e:
+            # the socket is stuck with the request, replace it
+            socket.close()
+            self.pool.put(self.pool.create())
+            if sent:
+                raise EswitchdTimeout(
+                    _("eSwitchD did not answer %(action)s: %(exc)s") %
+                    {'action': msg['action'], 'exc': e})
+            raise EswitchdUnavailable(
+                _("Failed to send %(action)s to eSwitchD: %(exc)s") %
+                {'action': msg['action'], 'exc': e})
+        finally:
+            timeout.cancel()
+        self.pool.put(socket)
+        return self.parse_response(jsonutils.loads(recv_msg))
+
+    def parse_response(self, msg):
+        if msg['status'] == 'OK':
+            return msg.get('response')
+        if msg['status'] == 'FAIL':
+            error_msg = (_("Action %(action)s failed: %(reason)s") %
+                         {'action': msg.get('action'),
+                          'reason': msg.get('reason')})
+        else:
+            error_msg = _("Unknown operation status %s") % msg['status']
+        LOG.error(error_msg)
+        raise EswitchdError(error_msg)
+
+    def batch(self, msgs):
+        """Send several requests to eSwitchD in a single one.
+
+        Falls back to sending them one by one if the daemon does not
+        support the batch action. Then a request which could not be sent
+        ends the batch with the EswitchdUnavailable error, unless it is the
+        first one.
+
+        :param msgs: list of request dicts
+        :returns: list of the response of each request, or of the
+                  EswitchdError it failed with, in the same order
+        :raises: EswitchdUnavailable if the request could not be sent,
+                 EswitchdTimeout if the daemon did not answer it
+        """
+        if self.batch_supported:
+            try:
+                responses = self.send_msg({'action': 'batch', 'ops': msgs})
+            except EswitchdError:
+                LOG.warning(_("eSwitchD does not support batch requests, "
+                              "sending requests one by one"))
+                self.batch_supported = False
+            else:
+                return [self._get_result(self.parse_response, response)
+                        for response in responses]
+        results = []
+        for msg in msgs:
+            try:
+                results.append(self._get_result(self.send_msg, msg))
+            except EswitchdUnavailable as e:
+                if not results:
+                    raise
+                # the requests before were done, they must not be run again
+                results.append(e)
+                break
+        return results
+
+    def _get_result(self, func, msg):
+        try:
+            return func(msg)
+        except EswitchdError as e:
+            return e
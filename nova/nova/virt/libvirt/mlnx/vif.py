@@ -16,16 +16,41 @@
 # limitations under the License.
 
 import re
+import time
+from oslo.config import cfg
+from nova.compute import task_states
 from nova import exception
+from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova import utils
 from nova.openstack.common.gettextutils import _
 from nova.virt.libvirt import vif
+from nova.virt.libvirt.mlnx import client
 from nova.virt.libvirt.mlnx import config  as mlxconfig
 
+mlnx_vif_opts = [
+    cfg.StrOpt('mlnx_eswitchd_endpoint',
+               default='tcp://127.0.0.1:5001',
+               help='eSwitchD end point the VIF driver sends its requests '
+                    'to. Set to empty to run ebrctl for each request'),
+    cfg.IntOpt('mlnx_eswitchd_timeout',
+               default=3000,
+               help='Number of milliseconds to wait for an eSwitchD answer '
+                    'before running ebrctl instead'),
+    cfg.IntOpt('mlnx_eswitchd_pool_size',
+               default=4,
+               help='Maximum number of connections to eSwitchD used for '
+                    'concurrent requests'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(mlnx_vif_opts)
+
 LOG = logging.getLogger(__name__)
 HEX_BASE = 16
 VIF_TYPE_HOSTDEV = 'hostdev'
+# seconds the devices allocated at spawn are kept for get_config and plug
+RESERVATION_TTL = 300
 
 
 class MlxEthVIFDriver(vif.LibvirtBaseVIFDriver):
@@ -33,6 +58,161 @@ class MlxEthVIFDriver(vif.LibvirtBaseVIFDriver):
     def __init__(self, get_connection):
         super(MlxEthVIFDriver, self).__init__(get_connection)
         self.libvirt_gen_drv = vif.LibvirtGenericVIFDriver(get_connection)
+        self.eswitchd = None
+        if CONF.mlnx_eswitchd_endpoint:
+            self.eswitchd = client.EswitchdClient(
+                CONF.mlnx_eswitchd_endpoint, CONF.mlnx_eswitchd_timeout,
+                CONF.mlnx_eswitchd_pool_size)
+        # device_id -> (expires, {vnic_mac: dev}, set of vnic_mac) of the
+        # instances spawned, with the devices allocated to their vNICs
+        # until get_config, and the vNICs plugged until plug
+        self.reservations = {}
+
+    def _ebrctl(self, msg, command):
+        """Send a request to eSwitchD, or run ebrctl for it.
+
+        ebrctl is run if there is no connection to eSwitchD. It is not run
+        for a request sent to the daemon which did not answer, as the
+        action may have been done.
+
+        :param msg: eSwitchD request
+        :param command: ebrctl arguments of the same request
+        :returns: the answer of the daemon
+        """
+        if self.eswitchd is not None:
+            try:
+                return self.eswitchd.send_msg(msg)
+            except client.EswitchdUnavailable as e:
+                LOG.warning(_("Running ebrctl as %s"), e)
+        return utils.execute('ebrctl', *command)[0].strip()
+
+    def _ebrctl_batch(self, requests):
+        """Send several requests to eSwitchD at once, or run ebrctl.
+
+        ebrctl is run for one request after the other, and stops at the
+        first failure.
+
+        :param requests: list of (eSwitchD request, ebrctl arguments)
+        :returns: list of the answers of the daemon, or of the errors,
+                  to the requests sent
+        :raises: EswitchdTimeout if the daemon did not answer
+        """
+        if self.eswitchd is not None:
+            try:
+                return self.eswitchd.batch([msg for msg, command
+                                            in requests])
+            except client.EswitchdUnavailable as e:
+                LOG.warning(_("Running ebrctl as %s"), e)
+        results = []
+        for msg, command in requests:
+            try:
+                results.append(utils.execute('ebrctl',
+                                             *command)[0].strip())
+            except exception.ProcessExecutionError as e:
+                results.append(e)
+                break
+        return results
+
+    def allocate_ports(self, instance, vifs):
+        """Allocate and plug all the hostdev vNICs of an instance spawned.
+
+        Either all or none of the vNICs are allocated. The devices of the
+        vNICs are kept, so the next get_config and plug of each vNIC need
+        no more requests.
+        """
+        device_id = instance['uuid']
+        vifs = [vif for vif in vifs
+                if vif.get('type') == VIF_TYPE_HOSTDEV]
+        if not vifs:
+            return
+        requests = []
+        for vif in vifs:
+            vnic_mac = vif['address']
+            fabric = vif['network']['meta']['physical_network']
+            requests.append((
+                client.create_port_msg(vnic_mac, device_id, fabric,
+                                       VIF_TYPE_HOSTDEV),
+                ('allocate-port', vnic_mac, device_id, fabric,
+                 VIF_TYPE_HOSTDEV)))
+            requests.append((
+                client.plug_nic_msg(vnic_mac, device_id, fabric,
+                                    VIF_TYPE_HOSTDEV, None),
+                ('add-port', vnic_mac, device_id, fabric,
+                 VIF_TYPE_HOSTDEV, None)))
+        try:
+            results = self._ebrctl_batch(requests)
+        except client.EswitchdTimeout as e:
+            # which vNICs got a device is not known, the failed spawn
+            # unplugs them
+            LOG.error(_("Failed to allocate vNICs: %s"), e,
+                      instance=instance)
+            raise exception.NovaException(_("Failed to allocate devices "
+                                            "for vNICs"))
+        errors = [result for result in results
+                  if isinstance(result, Exception)]
+        if not errors and len(results) == len(requests):
+            devs = dict((vif['address'], dev)
+                        for vif, dev in zip(vifs, results[::2]))
+            self.reservations[device_id] = (time.time() + RESERVATION_TTL,
+                                            devs, set(devs))
+            return
+        LOG.error(_("Failed to allocate vNICs: %s"), errors,
+                  instance=instance)
+        # release only the devices allocated by this request
+        self._release_ports(instance,
+                            [vif for vif, dev in zip(vifs, results[::2])
+                             if not isinstance(dev, Exception)])
+        raise exception.NovaException(_("Failed to allocate devices for "
+                                        "vNICs"))
+
+    def _release_ports(self, instance, vifs):
+        """Release the devices of vNICs, logging failures."""
+        if not vifs:
+            return
+        requests = []
+        for vnic in vifs:
+            vnic_mac = vnic['address']
+            fabric = vnic['network']['meta']['physical_network']
+            requests.append((client.delete_port_msg(fabric, vnic_mac),
+                             ('del-port', fabric, vnic_mac)))
+        try:
+            results = self._ebrctl_batch(requests)
+        except client.EswitchdTimeout as e:
+            results = [e]
+        for error in results:
+            if isinstance(error, Exception):
+                LOG.warning(_("Failed to release vNIC: %s"), error,
+                            instance=instance)
+
+    def _get_reservation(self, instance):
+        """Get the reservation of an instance, dropping expired ones."""
+        now = time.time()
+        for device_id, reservation in self.reservations.items():
+            if reservation[0] < now:
+                del self.reservations[device_id]
+        return self.reservations.get(instance['uuid'])
+
+    def _get_reserved_dev(self, instance, vif):
+        """Get the device reserved to the vNIC, if any.
+
+        The vNICs of an instance are allocated together on the first
+        get_config of its spawn, when its network info is known. Each
+        device is used once, other get_config allocate the vNIC alone.
+        """
+        reservation = self._get_reservation(instance)
+        if (reservation is None and
+                instance.get('task_state') == task_states.SPAWNING):
+            try:
+                network_info = instance['info_cache']['network_info']
+            except (KeyError, TypeError):
+                network_info = None
+            if isinstance(network_info, basestring):
+                network_info = jsonutils.loads(network_info)
+            if network_info:
+                self.allocate_ports(instance, network_info)
+                reservation = self._get_reservation(instance)
+        if reservation is not None:
+            return reservation[1].pop(vif['address'], None)
 
     def get_dev_config(self, mac_address, dev):
         conf = None
@@ -54,12 +234,18 @@ class MlxEthVIFDriver(vif.LibvirtBaseVIFDriver):
         try:
             if vif_type == VIF_TYPE_HOSTDEV:
                 dev_name = None
+                dev = self._get_reserved_dev(instance, vif)
+                if dev is not None:
+                    return self.get_dev_config(vnic_mac, dev)
                 try:
-                    res = utils.execute('ebrctl', 'allocate-port',
-                                        vnic_mac, device_id, fabric, vif_type)
-                    dev = res[0].strip()
+                    dev = self._ebrctl(
+                        client.create_port_msg(vnic_mac, device_id, fabric,
+                                               vif_type),
+                        ('allocate-port', vnic_mac, device_id, fabric,
+                         vif_type))
 
-                except exception.ProcessExecutionError:
+                except (exception.ProcessExecutionError,
+                        client.EswitchdError, client.EswitchdTimeout):
                     LOG.exception(_("Failed while config vif"),
                                   instance=instance)
                     dev = None
@@ -91,11 +277,16 @@ class MlxEthVIFDriver(vif.LibvirtBaseVIFDriver):
 
         try:
             if vif_type == VIF_TYPE_HOSTDEV:
-                dev = utils.execute('ebrctl', 'add-port', vnic_mac, device_id,
-                                    fabric, vif_type, dev_name)
-                if dev is None:
-                    error_msg = "Cannot plug VIF with no allocated device "
-                    raise exception.NovaException(_(error_msg))
+                reservation = self._get_reservation(instance)
+                if reservation is not None and vnic_mac in reservation[2]:
+                    reservation[2].discard(vnic_mac)
+                    LOG.debug(_("vNIC %s is already plugged"), vnic_mac)
+                    return
+                self._ebrctl(
+                    client.plug_nic_msg(vnic_mac, device_id, fabric,
+                                        vif_type, dev_name),
+                    ('add-port', vnic_mac, device_id, fabric, vif_type,
+                     dev_name))
             else:
                 self.libvirt_gen_drv.plug(instance, vif)
 
@@ -115,7 +306,12 @@ class MlxEthVIFDriver(vif.LibvirtBaseVIFDriver):
 
         try:
             if vif_type == VIF_TYPE_HOSTDEV:
-                utils.execute('ebrctl', 'del-port', fabric, vnic_mac)
+                reservation = self._get_reservation(instance)
+                if reservation is not None:
+                    reservation[1].pop(vnic_mac, None)
+                    reservation[2].discard(vnic_mac)
+                self._ebrctl(client.delete_port_msg(fabric, vnic_mac),
+                             ('del-port', fabric, vnic_mac))
             else:
                 self.libvirt_gen_drv.unplug(instance, vif)
         except Exception, e:
@@ -0,0 +1,104 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Benchmark of the boot path of instances with hostdev vNICs.
+
+    Allocates and plugs all the vNICs of an instance, as at its boot,
+    then unplugs them. This is done with the vNICs allocated in a single
+    eSwitchD request, with a request sent for each of them and with
+    ebrctl run for each of them, and the p50/p99 latency of each is
+    printed. Run it on a compute node where eSwitchD runs, with
+    free Virtual Functions on the fabric:
+
+    python tools/mlnx_vif_benchmark.py --fabric default
+"""
+import argparse
+import random
+import time
+import uuid
+
+from nova.virt.libvirt.mlnx import vif as mlnx_vif
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def fake_vifs(count, fabric):
+    return [{'type': mlnx_vif.VIF_TYPE_HOSTDEV,
+             'address': 'fa:16:3e:%02x:%02x:%02x' % (
+                 random.randint(0, 255), random.randint(0, 255), i),
+             'network': {'meta': {'physical_network': fabric}}}
+            for i in range(count)]
+
+
+def boot(driver, vifs, batch):
+    """Allocate and plug the vNICs of a new instance.
+
+    :param batch: allocate all the vNICs before their get_config
+    :returns: seconds the boot path took
+    """
+    instance = {'uuid': str(uuid.uuid4())}
+    start = time.time()
+    try:
+        if batch:
+            driver.allocate_ports(instance, vifs)
+        for vif in vifs:
+            driver.get_config(instance, vif, None, None)
+            driver.plug(instance, vif)
+        return time.time() - start
+    finally:
+        for vif in vifs:
+            driver.unplug(instance, vif)
+
+
+def run(driver, mode, args, batch=False):
+    latencies = [boot(driver, fake_vifs(args.vifs, args.fabric), batch)
+                 for i in range(args.rounds)]
+    print("%(mode)-9s boot of %(vifs)d vNICs: p50 %(p50).3fs "
+          "p99 %(p99).3fs (%(per_vif).1fms per vNIC)" %
+          {'mode': mode, 'vifs': args.vifs,
+           'p50': percentile(latencies, 50),
+           'p99': percentile(latencies, 99),
+           'per_vif': percentile(latencies, 50) * 1000 / args.vifs})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--fabric', default='default',
+                        help='physical network of the vNICs')
+    parser.add_argument('--vifs', type=int, default=16,
+                        help='number of vNICs of an instance')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='number of instance boots of each mode')
+    args = parser.parse_args()
+    mlnx_vif.CONF(args=[], project='nova')
+
+    driver = mlnx_vif.MlxEthVIFDriver(None)
+    if driver.eswitchd is None:
+        parser.error('mlnx_eswitchd_endpoint is not set')
+    run(driver, 'batch', args, batch=True)
+    run(driver, 'eswitchd', args)
+    driver.eswitchd = None
+    run(driver, 'ebrctl', args)
+
+
+if __name__ == '__main__':
+    main()